@@ -3,13 +3,14 @@ Format raw Pupil Labs data.
 
 Tested with Python 3.6, open CV 3.2
 
-The raw input data will be copied to a new directory stored in ./data.
+The raw input data is read in place; the outputs are written to a new directory stored in ./data.
 The output directory will be  named according to [mo-day-yr]/[hr-min-sec] of the original creation time format.
 
 The output directory will contain:
 	- worldCamera.mp4: the video from the point-of-view scene camera on the glasses
-	- frame_timestamps.tsv: table of timestamps for each frame in the world
-	- gazeData_world.tsv: gaze data, where all gaze coordinates are represented w/r/t the world camera
+	- frame_timestamps.<fmt>: table of timestamps for each frame in the world
+	- gazeData_world.<fmt>: gaze data, where all gaze coordinates are represented w/r/t the world camera
+(tables are written as feather by default; see gazeTables.py for the other formats)
 """
 
 # python 2/3 compatibility
@@ -18,19 +19,26 @@ from __future__ import print_function
 
 import sys, os, shutil
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from os.path import join
 import numpy as np
 import pandas as pd
-import csv
-from itertools import chain
 
-import gc
 import msgpack
 
-def preprocessData(inputDir, output_root):
+sys.path.append(join(os.path.dirname(os.path.abspath(__file__)), '..', 'gazeMappingPipeline'))
+from gazeTables import writeGazeData, writeFrameTimestamps, tableFormats
+from gazeAlignment import alignToFrames
+from videoTools import transcodeVideo, defaultEncodeOptions, x264Presets
+
+def preprocessData(inputDir, output_root, tableFormat=None, encodeOptions=None):
 	"""
 	Run all preprocessing steps for pupil lab data
+
+	encodeOptions: x264 settings for the world camera video (see videoTools.transcodeVideo)
+
+	Returns the path to the output dir
 	"""
 	### Prep output directory
 	info_file = join(inputDir, 'info.csv')  	# get the timestamp from the info.csv file
@@ -50,44 +58,24 @@ def preprocessData(inputDir, output_root):
 	if not os.path.isdir(outputDir):
 		os.makedirs(outputDir)
 
-	### Format the gaze data
-	print('formatting gaze data...')
-	gazeData_world, frame_timestamps = formatGazeData(inputDir)
-
-	# write the gazeData to to a csv file
-	print('writing file to csv...')
-	csv_file = join(outputDir, 'gazeData_world.tsv')
-	export_range = slice(0, len(gazeData_world))
-	with open(csv_file, 'w', encoding='utf-8', newline='') as csvfile:
-		csv_writer = csv.writer(csvfile, quoting=csv.QUOTE_NONE)
-		csv_writer.writerow(['{}\t{}\t{}\t{}\t{}'.format("timestamp",
-							"frame_idx",
-							"confidence",
-							"norm_pos_x",
-							"norm_pos_y")])
-		for g in list(chain(*gazeData_world[export_range])):
-			data = ['{:.3f}\t{:d}\t{:.1f}\t{:.3f}\t{:.3f}'.format(g["timestamp"]*1000,
-								g["frame_idx"],
-								g["confidence"],
-								g["norm_pos"][0],
-								1-g["norm_pos"][1])]  # translate y coord to origin in top-left
-			csv_writer.writerow(data)
-
-	# write the frametimestamps to a csv file
-	frameNum = np.arange(1, frame_timestamps.shape[0]+1)
-	frame_ts_df = pd.DataFrame({'frameNum': frameNum, 'timestamp':frame_timestamps})
-	frame_ts_df.to_csv(join(outputDir, 'frame_timestamps.tsv'), sep='\t', float_format='%.3f', index=False)
-
-	### Compress and Move the world camera movie to the output
-	print('copying world recording movie...')
-	if not 'worldCamera.mp4' in os.listdir(outputDir):
-		# compress
-		print('compressing world camera video')
-		cmd_str = ' '.join(['ffmpeg', '-i', join(inputDir, 'world.mp4'), '-pix_fmt', 'yuv420p', join(inputDir, 'worldCamera.mp4')])
-		os.system(cmd_str)
-
-		# move the file to the output directory
-		shutil.move(join(inputDir, 'worldCamera.mp4'), join(outputDir, 'worldCamera.mp4'))
+	### Compress the world camera movie straight into the output dir, in the background
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		transcode = executor.submit(transcodeVideo, join(inputDir, 'world.mp4'), join(outputDir, 'worldCamera.mp4'),
+									encodeOptions=encodeOptions)
+
+		### Format the gaze data
+		print('formatting gaze data...')
+		gaze, frame_timestamps = formatGazeData(inputDir)
+
+		# write the gaze data and frame timestamps
+		print('writing gaze data...')
+		writeGazeData(outputDir, gaze, tableFormat)
+		writeFrameTimestamps(outputDir, frame_timestamps, tableFormat)
+
+		# wait for the movie (raises any transcoding error)
+		transcode.result()
+
+	return outputDir
 
 
 def formatGazeData(inputDir):
@@ -95,76 +83,93 @@ def formatGazeData(inputDir):
 	- load the pupil_data and timestamps
 	- get the "gaze" fields from pupil data (i.e. the gaze lcoation w/r/t world camera)
 	- sync gaze data with the world_timestamps array
+	- convert to the standard gaze table columns (timestamps in ms, gaze y origin at the top-left)
 	"""
 
-	# load pupil data
-	pupil_data_path = join(inputDir, 'pupil_data')
-	with open(pupil_data_path, 'rb') as fh:
-		try:
-			gc.disable()
-			pupil_data = msgpack.unpack(fh, encoding='utf-8')
-		except Exception as e:
-			print(e)
-		finally:
-			gc.enable()
-	gaze_list = pupil_data['gaze_positions']   # gaze posiiton (world camera)
+	# load gaze positions (world camera) from the pupil data
+	gaze = readGazePositions(join(inputDir, 'pupil_data'))
 
 	# load timestamps
 	timestamps_path = join(inputDir, 'world_timestamps.npy')
 	frame_timestamps = np.load(timestamps_path)
 
 	# align gaze with world camera timestamps
-	gaze_by_frame = correlate_data(gaze_list, frame_timestamps)
+	gaze = correlate_data(gaze, frame_timestamps)
 
 	# make frame_timestamps relative to the first data timestamp
-	start_timeStamp = gaze_by_frame[0][0]['timestamp']
+	start_timeStamp = gaze['timestamp'][0]
 	frame_timestamps = (frame_timestamps - start_timeStamp) * 1000 # convert to ms
 
-	return gaze_by_frame, frame_timestamps
-
+	gaze['timestamp'] = gaze['timestamp'] * 1000		# convert to ms
+	gaze['norm_pos_y'] = 1 - gaze['norm_pos_y']		# translate y coord to origin in top-left
 
-def correlate_data(data,timestamps):
-	'''
-	data:  list of data :
-		each datum is a dict with at least:
-			timestamp: float
+	return gaze, frame_timestamps
 
-	timestamps: timestamps list to correlate  data to
 
-	this takes a data list and a timestamps list and makes a new list
-	with the length of the number of timestamps.
-	Each slot contains a list that will have 0, 1 or more assosiated data points.
-
-	Finally we add an index field to the datum with the associated index
-	'''
-	timestamps = list(timestamps)
-	data_by_frame = [[] for i in timestamps]
-
-	frame_idx = 0
-	data_index = 0
-
-	data.sort(key=lambda d: d['timestamp'])
+def readGazePositions(pupil_data_path):
+	"""
+	Stream the gaze positions out of the pupil_data msgpack file
 
-	while True:
-		try:
-			datum = data[data_index]
-			# we can take the midpoint between two frames in time: More appropriate for SW timestamps
-			ts = ( timestamps[frame_idx]+timestamps[frame_idx+1] ) / 2.
-			# or the time of the next frame: More appropriate for Sart Of Exposure Timestamps (HW timestamps).
-			# ts = timestamps[frame_idx+1]
-		except IndexError:
-			# we might loose a data point at the end but we dont care
-			break
+	pupil_data is a map of sections (pupil_positions, gaze_positions, notifications, ...).
+	Only the gaze_positions section is decoded, and only the fields needed here are read
+	from each gaze datum; everything else (incl. each datum's base_data) is skipped unparsed.
 
-		if datum['timestamp'] <= ts:
-			datum['frame_idx'] = frame_idx
-			data_by_frame[frame_idx].append(datum)
-			data_index +=1
-		else:
-			frame_idx+=1
+	Returns a dict of arrays: timestamp (s), confidence, norm_pos_x, norm_pos_y
+	"""
+	fields = ['timestamp', 'confidence', 'norm_pos_x', 'norm_pos_y']
+	gaze = {f: np.empty(0) for f in fields}
+	with open(pupil_data_path, 'rb') as fh:
+		unpacker = msgpack.Unpacker(fh, raw=False)
+		for i in range(unpacker.read_map_header()):
+			section = unpacker.unpack()
+			if section != 'gaze_positions':
+				unpacker.skip()
+				continue
+
+			nGaze = unpacker.read_array_header()
+			gaze = {f: np.empty(nGaze, dtype=np.float64) for f in fields}
+			for j in range(nGaze):
+				found = set()
+				for k in range(unpacker.read_map_header()):
+					field = unpacker.unpack()
+					if field in ['timestamp', 'confidence']:
+						gaze[field][j] = unpacker.unpack()
+						found.add(field)
+					elif field == 'norm_pos':
+						gaze['norm_pos_x'][j], gaze['norm_pos_y'][j] = unpacker.unpack()
+						found.add(field)
+					else:
+						unpacker.skip()
+
+				# every row must be set (the arrays start out uninitialized)
+				if len(found) < 3:
+					missing = sorted(set(['timestamp', 'confidence', 'norm_pos']) - found)
+					raise KeyError('gaze datum {} has no {} field'.format(j, ', '.join(missing)))
+
+	return gaze
+
+
+def correlate_data(data, timestamps, policy='midpoint'):
+	"""
+	data: dict of equal-length arrays, incl. timestamp
+	timestamps: (sorted) frame timestamps to correlate the data to
+
+	Returns a copy of data, sorted by timestamp, with a frame_idx array giving the frame
+	each datum belongs to (see gazeAlignment.py for the policies):
+		- policy='midpoint': More appropriate for SW timestamps
+		- policy='next': More appropriate for Start Of Exposure Timestamps (HW timestamps)
+	Data that don't fall in any frame are dropped
+	"""
+	# sort the data by timestamp (stable, so ties keep their order)
+	order = np.argsort(data['timestamp'], kind='mergesort')
+	frame_idx = alignToFrames(data['timestamp'][order], timestamps, policy=policy, unmatched='flag')
 
-	return data_by_frame
+	# we might loose data points at the end but we dont care
+	keep = frame_idx >= 0
+	correlated = {k: np.asarray(v)[order][keep] for k, v in data.items()}
+	correlated['frame_idx'] = frame_idx[keep]
 
+	return correlated
 
 
 if __name__ == '__main__':
@@ -172,6 +177,10 @@ if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('inputDir', help='path to the raw pupil labs recording dir')
 	parser.add_argument('outputDir', help='output directory root. Raw data will be written to recording specific dirs within this directory')
+	parser.add_argument('--tableFormat', choices=tableFormats, default=None, help='format for the output gaze tables')
+	parser.add_argument('--preset', choices=x264Presets, default=defaultEncodeOptions['preset'], help='x264 preset for the world camera video')
+	parser.add_argument('--crf', type=int, default=defaultEncodeOptions['crf'], help='x264 constant rate factor (quality; lower is better)')
+	parser.add_argument('--threads', type=int, default=None, help='number of ffmpeg threads (default: chosen by ffmpeg)')
 	args = parser.parse_args()
 
 	# check if input directory is valid
@@ -181,4 +190,5 @@ if __name__ == '__main__':
 	else:
 
 		# run preprocessing on this data
-		preprocessData(args.inputDir, args.outputDir)
+		preprocessData(args.inputDir, args.outputDir, tableFormat=args.tableFormat,
+						encodeOptions={'preset': args.preset, 'crf': args.crf, 'threads': args.threads})
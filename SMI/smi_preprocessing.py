@@ -3,13 +3,14 @@ Format raw SMI data.
 
 Tested with Python 3.6, open CV 3.2
 
-The raw input data will be copied to a new directory stored in ./data.
+The raw input data is read in place; the outputs are written to a new directory stored in ./data.
 The output directory will be  named according to [mo-day-yr]/[hr-min-sec] of the original creation time format.
 
 The output directory will contain:
 	- worldCamera.mp4: the video from the point-of-view scene camera on the glasses
-	- frame_timestamps.tsv: table of timestamps for each frame in the world
-	- gazeData_world.tsv: gaze data, where all gaze coordinates are represented w/r/t the world camera
+	- frame_timestamps.<fmt>: table of timestamps for each frame in the world
+	- gazeData_world.<fmt>: gaze data, where all gaze coordinates are represented w/r/t the world camera
+(tables are written as feather by default; see gazeTables.py for the other formats)
 """
 
 # python 2/3 compatibility
@@ -18,54 +19,55 @@ from __future__ import print_function
 
 import sys, os, shutil
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from os.path import join
 import numpy as np
 import pandas as pd
 import cv2
 
+sys.path.append(join(os.path.dirname(os.path.abspath(__file__)), '..', 'gazeMappingPipeline'))
+from gazeTables import writeGazeData, writeFrameTimestamps, tableFormats
+from videoTools import transcodeVideo, defaultEncodeOptions, x264Presets
+from gazeAlignment import alignToFrames
+
 OPENCV3 = (cv2.__version__.split('.')[0] == '3')
 print("OPENCV version " + cv2.__version__)
 
-def preprocessData(inputDir, sessionNum, output_root):
+def preprocessData(inputDir, sessionNum, output_root, tableFormat=None, encodeOptions=None):
 	"""
 	Run all preprocessing steps for SMI data
+
+	encodeOptions: x264 settings for the world camera video (see videoTools.transcodeVideo)
+
+	Returns the path to the output dir
 	"""
-	### create output directory
-	print('Copying raw data...')
-	newDataDir = copySMI_recording(inputDir, sessionNum, output_root)
-	print('Input data copied to: {}'.format(newDataDir))
-
-	### Format the gaze data
-	print('Prepping the gaze data...')
-	gazeWorld_df, frame_timestamps = formatGazeData(newDataDir)
-	gazeWorld_df.to_csv(join(newDataDir, 'gazeData_world.tsv'), sep='\t', index=False, float_format='%.3f')
-
-	### convert the frame_timestamps to dataframe
-	print('Formatting timestamps...')
-	frameNum = np.arange(1, frame_timestamps.shape[0]+1)
-	frame_ts_df = pd.DataFrame({'frameNum':frameNum, 'timestamp':frame_timestamps})
-	frame_ts_df.to_csv(join(newDataDir, 'frame_timestamps.tsv'), sep='\t', index=False, float_format='%.3f')
-
-	### convert movie from avi to mp4
-	print('Converting movie file...')
-	convertSMImovie(newDataDir)
-
-	### compress movie
-	print('Compressing movie file...')
-	cmd_str = ' '.join(['ffmpeg', '-i', join(newDataDir, 'SMI_worldCamera.mp4'), '-pix_fmt', 'yuv420p', join(newDataDir, 'worldCamera.mp4')])
-	os.system(cmd_str)
-
-	### clean up
-	for f in ['SMI_worldCamera.avi', 'SMI_worldCamera.mp4', 'SMI_raw.txt']:
-		try:
-			os.remove(join(newDataDir, f))
-		except:
-			pass
-
-
-def copySMI_recording(inputDir, sessionNum, output_root):
+	### find the raw files for this session (read in place), and create output directory
+	vidPath, rawPath = findSMI_recording(inputDir, sessionNum)
+	newDataDir = makeOutputDir(inputDir, sessionNum, output_root)
+	print('Output will be saved to: {}'.format(newDataDir))
+
+	### convert movie from avi to mp4 in the background, reading the frame timestamps in the same pass
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		transcode = executor.submit(transcodeVideo, vidPath, join(newDataDir, 'worldCamera.mp4'),
+									frameTimestamps=True, encodeOptions=encodeOptions)
+
+		### Format the gaze data
+		print('Prepping the gaze data...')
+		gazeWorld_df = formatGazeData(rawPath, vidPath)
+		writeGazeData(newDataDir, gazeWorld_df, tableFormat)
+
+		# wait for the movie (raises any transcoding error)
+		frame_timestamps = transcode.result()
+		writeFrameTimestamps(newDataDir, frame_timestamps, tableFormat)
+
+	return newDataDir
+
+
+def makeOutputDir(inputDir, sessionNum, output_root):
 	"""
+	Create the output directory for this session.
+
 	The SMI data is timestamped according to when it was exported, not when it was
 	recorded. If you export multiple sessions at once, they have the same timestamp.
 	Thus, instead of saving each session with a directory structure like the Tobii and PL data (i.e. data/time), the SMI data will get saved with a structure like
@@ -80,35 +82,57 @@ def copySMI_recording(inputDir, sessionNum, output_root):
 	if not os.path.isdir(outputDir):
 		os.makedirs(outputDir)
 
-	# copy the relevant data to the new directory
+	return outputDir
+
+
+def findSMI_recording(inputDir, sessionNum):
+	"""
+	Find the movie and raw data files for this session in the SMI export dir
+
+	Returns the paths to the movie file and the raw data file
+	"""
+	vidPath = None
+	rawPath = None
 	for f in os.listdir(inputDir):
 		# movie file
 		if ('-' + str(sessionNum) + '-') in f:
-			shutil.copy(join(inputDir, f), join(outputDir, 'SMI_worldCamera.avi'))
+			vidPath = join(inputDir, f)
 
 		# data file
 		if ('_' + str(sessionNum).zfill(3) + '_') in f:
-			shutil.copy(join(inputDir, f), join(outputDir, 'SMI_raw.txt'))
-	return outputDir
+			rawPath = join(inputDir, f)
+
+	if (vidPath is None) or (rawPath is None):
+		raise IOError('Could not find the movie and raw data files for session {} in {}'.format(sessionNum, inputDir))
+	return vidPath, rawPath
 
-def formatGazeData(input_dir):
+
+# columns read from the raw SMI export, and their types
+rawColumnTypes = {'Time': np.float64,
+					'Frame': str,
+					'B POR X [px]': np.float64,
+					'B POR Y [px]': np.float64,
+					'B Event Info': str}
+
+
+def formatGazeData(raw_path, vid_path):
 	"""
-	load the raw SMI gaze data.
+	load the raw SMI gaze data (raw_path) and world camera movie (vid_path).
 	Convert timestamps from microseconds, to ms
 	normalize gaze coordinates to frame size
 	reformat frame column
 	set confidence based on event info
 	"""
 
-	# open the raw gaze data as dataframe
-	raw_df = pd.read_table(join(input_dir, 'SMI_raw.txt'))
+	# open the raw gaze data as dataframe (only the columns used here)
+	raw_df = pd.read_table(raw_path, usecols=list(rawColumnTypes.keys()), dtype=rawColumnTypes)
 
 	# convert timestamps from microseconds to ms
 	ts = raw_df['Time']/1000
 
 	### normalize gaze coords to frame size
 	# get vid size
-	vid = cv2.VideoCapture(join(input_dir, 'SMI_worldCamera.avi'))
+	vid = cv2.VideoCapture(vid_path)
 	if OPENCV3:
 		vidSize = (int(vid.get(cv2.CAP_PROP_FRAME_WIDTH)), int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT)))
 	else:
@@ -120,34 +144,11 @@ def formatGazeData(input_dir):
 	norm_pos_y = raw_df['B POR Y [px]'] / vidSize[1]
 
 	### reformat frame index column
-	frameIndices = np.zeros(shape=raw_df.shape[0])
-
-	# starting values
-	frameCounter = 0
-	prevLabel = raw_df.Frame.iloc[0]
-
-	# loop over all frames
-	for i,frame in enumerate(raw_df.Frame):
-		# if this frame lable is different than the previous one, update the frame counter
-		if frame != prevLabel:
-			frameCounter += 1
-
-		# assign the frameCounter value on this frame to the frame_indices array
-		frameIndices[i] = frameCounter
+	# the frame counter goes up by one every time the frame label differs from the previous sample's
+	frame_idx = alignToFrames(raw_df.Frame.values, policy='label')
 
-		# update the previous frame label var
-		prevLabel = frame
-
-	# create a Series object of the frame indices
-	frame_idx = pd.Series(frameIndices.astype(int), name='frame_idx')
-
-	### Set confidence based on event labels
-	conf = np.zeros(shape=raw_df.shape[0])
-	for i,eventLabel in enumerate(raw_df['B Event Info']):
-		if eventLabel == 'Blink':
-			conf[i] = 0
-		else:
-			conf[i] = 1
+	### Set confidence based on event labels (0 during blinks)
+	conf = (raw_df['B Event Info'].values != 'Blink').astype(np.float32)
 
 	### build the dataframe
 	gaze_df = pd.DataFrame({'timestamp': ts, 'frame_idx':frame_idx,
@@ -155,83 +156,7 @@ def formatGazeData(input_dir):
 							'confidence':conf})
 	colOrder = ['timestamp', 'frame_idx', 'confidence', 'norm_pos_x', 'norm_pos_y']
 
-	### Figure out the frame timestamps
-	frame_timestamps = getVidFrameTimestamps(join(input_dir, 'SMI_worldCamera.avi'))
-
-	return gaze_df[colOrder], frame_timestamps
-
-
-def getVidFrameTimestamps(vid_file):
-	"""
-	Load the supplied video, return an array of frame timestamps
-	"""
-	vid = cv2.VideoCapture(vid_file)
-
-	# figure out the total number of frames in this video file
-	if OPENCV3:
-		totalFrames = vid.get(cv2.CAP_PROP_FRAME_COUNT)
-	else:
-		totalFrames = vid.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
-	frame_ts = np.zeros(int(totalFrames))
-	print(totalFrames)
-
-	# loop through all video frames
-	frameCounter = 0
-	while vid.isOpened():
-		# read the next frame
-		ret, frame = vid.read()
-
-		# check if its valid:
-		if ret == True:
-			if OPENCV3:
-				thisFrameTS = vid.get(cv2.CAP_PROP_POS_MSEC)
-			else:
-				thisFrameTS = vid.get(cv2.cv.CV_CAP_PROP_POS_MSEC)
-
-			# write this frame's ts to the array
-			frame_ts[frameCounter] = thisFrameTS
-
-			# increment frame counter
-			frameCounter += 1
-			print(frameCounter, end=',')
-		else:
-			break
-	vid.release()		# close the video
-
-	return frame_ts
-
-
-def convertSMImovie(input_dir):
-	"""
-	Convert the move from AVI to mp4
-	"""
-	vid = cv2.VideoCapture(join(input_dir, 'SMI_worldCamera.avi'))
-	if OPENCV3:
-		fps = vid.get(cv2.CAP_PROP_FPS)
-		vidCodec = cv2.VideoWriter_fourcc(*'mp4v')
-		vidSize = (int(vid.get(cv2.CAP_PROP_FRAME_WIDTH)), int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT)))
-		totalFrames = vid.get(cv2.CAP_PROP_FRAME_COUNT)
-	else:
-		fps = vid.get(cv2.cv.CV_CAP_PROP_FPS)
-		vidCodec = cv2.cv.CV_FOURCC(*'mp4v')
-		vidSize = (int(vid.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH)), int(vid.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT)))
-		totalFrames = vid.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
-
-	# set up output video
-	vidOut_world_fname = join(input_dir, 'SMI_worldCamera.mp4')
-	vidOut_world = cv2.VideoWriter()
-	vidOut_world.open(vidOut_world_fname, vidCodec, fps, vidSize, True)
-
-	while vid.isOpened():
-		# read the next frame of video
-		ret, frame = vid.read()
-		if ret == True:
-			vidOut_world.write(frame)
-		else:
-			break
-	# close videos
-	vid.release()
-	vidOut_world.release()
+	return gaze_df[colOrder]
 
 
 if __name__ == '__main__':
@@ -240,6 +165,10 @@ if __name__ == '__main__':
 	parser.add_argument('inputDir', help='path to the raw SMI recording dir')
 	parser.add_argument('sessionNum', help='session number of SMI data')
 	parser.add_argument('outputDir', help='output directory root. Raw data will be written to recording specific dirs within this directory')
+	parser.add_argument('--tableFormat', choices=tableFormats, default=None, help='format for the output gaze tables')
+	parser.add_argument('--preset', choices=x264Presets, default=defaultEncodeOptions['preset'], help='x264 preset for the world camera video')
+	parser.add_argument('--crf', type=int, default=defaultEncodeOptions['crf'], help='x264 constant rate factor (quality; lower is better)')
+	parser.add_argument('--threads', type=int, default=None, help='number of ffmpeg threads (default: chosen by ffmpeg)')
 	args = parser.parse_args()
 
 	# check if input directory is valid
@@ -249,4 +178,5 @@ if __name__ == '__main__':
 	else:
 
 		# run preprocessing on this data
-		preprocessData(args.inputDir, args.sessionNum, args.outputDir)
+		preprocessData(args.inputDir, args.sessionNum, args.outputDir, tableFormat=args.tableFormat,
+						encodeOptions={'preset': args.preset, 'crf': args.crf, 'threads': args.threads})
@@ -0,0 +1,160 @@
+"""
+Batch preprocessing: find every raw recording from one manufacturer under a root dir, and
+run the preprocessing script on each of them in parallel
+
+Recordings are found by their raw files:
+	- pupillabs: dirs containing pupil_data and info.csv
+	- smi: exported raw data files (named like *_<sessionNum>_*) with a matching movie file
+	- tobii: dirs containing livedata.json.gz and segment.json
+
+Each recording is preprocessed in its own worker process. ffmpeg encodes are the most
+demanding step, so they are capped separately (--maxEncodes); the other workers keep
+formatting gaze data in the meantime.
+
+The status and processing time of every recording are written to a summary file
+(batchPreprocessing_summary.tsv in the output root, by default)
+"""
+
+# python 2/3 compatibility
+from __future__ import division
+from __future__ import print_function
+
+import os, sys
+import re
+import time
+import argparse
+import traceback
+import multiprocessing
+from os.path import join
+import pandas as pd
+
+from gazeTables import tableFormats
+from gazeIngest import vendors
+from videoTools import setEncodeLimit, defaultEncodeOptions, x264Presets
+
+
+def findRecordings(rawRoot, vendor):
+	"""
+	Walk rawRoot and return a list of the raw recordings for this vendor, as
+	(inputDir, sessionNum) tuples (sessionNum is None except for SMI)
+	"""
+	recordings = []
+	for thisDir, subDirs, files in os.walk(rawRoot):
+		subDirs.sort()
+		if vendor == 'pupillabs':
+			if 'pupil_data' in files and 'info.csv' in files:
+				recordings.append((thisDir, None))
+		elif vendor == 'tobii':
+			if 'livedata.json.gz' in files and 'segment.json' in files:
+				recordings.append((thisDir, None))
+		elif vendor == 'smi':
+			from smi_preprocessing import findSMI_recording
+			sessions = set()
+			for f in files:
+				session = re.search(r'_(\d{3})_', f)
+				if session and not f.lower().endswith('.avi'):
+					sessions.add(int(session.group(1)))
+			for sessionNum in sorted(sessions):
+				try:
+					findSMI_recording(thisDir, sessionNum)
+					recordings.append((thisDir, sessionNum))
+				except IOError:
+					print('Skipping SMI session {} in {}: no matching movie file'.format(sessionNum, thisDir))
+		else:
+			raise ValueError('Unknown vendor: {} (expected one of {})'.format(vendor, vendors))
+
+	return recordings
+
+
+def preprocessRecording(job):
+	"""
+	Run the preprocessing script for one recording (in a worker process), and return
+	a summary row with its status and timing
+	"""
+	vendor, inputDir, sessionNum, outputRoot, tableFormat, encodeOptions = job
+	summary = {'vendor': vendor, 'inputDir': inputDir, 'sessionNum': sessionNum,
+				'outputDir': None, 'status': 'ok', 'seconds': None, 'error': None}
+
+	startTime = time.time()
+	try:
+		if vendor == 'pupillabs':
+			from pl_preprocessing import preprocessData
+			summary['outputDir'] = preprocessData(inputDir, outputRoot, tableFormat=tableFormat, encodeOptions=encodeOptions)
+		elif vendor == 'smi':
+			from smi_preprocessing import preprocessData
+			summary['outputDir'] = preprocessData(inputDir, sessionNum, outputRoot, tableFormat=tableFormat,
+													encodeOptions=encodeOptions)
+		elif vendor == 'tobii':
+			from tobii_preprocessing import preprocessData
+			summary['outputDir'] = preprocessData(inputDir, outputRoot, tableFormat=tableFormat, encodeOptions=encodeOptions)
+	except Exception as e:
+		summary['status'] = 'failed'
+		summary['error'] = '{}: {}'.format(type(e).__name__, e)
+		traceback.print_exc()
+	summary['seconds'] = time.time() - startTime
+
+	return summary
+
+
+def batchPreprocess(vendor, rawRoot, outputRoot, workers=None, maxEncodes=2, tableFormat=None, encodeOptions=None,
+					summaryPath=None):
+	"""
+	Preprocess every recording for this vendor under rawRoot, using a pool of worker processes
+	(default: one per cpu), with at most maxEncodes ffmpeg encodes running at once.
+	encodeOptions: x264 settings for the world camera videos (see videoTools.transcodeVideo)
+
+	Returns the summary dataframe (also written to summaryPath)
+	"""
+	recordings = findRecordings(rawRoot, vendor)
+	print('Found {} {} recordings in {}'.format(len(recordings), vendor, rawRoot))
+	if len(recordings) == 0:
+		return None
+
+	if not os.path.isdir(outputRoot):
+		os.makedirs(outputRoot)
+	workers = min(workers or multiprocessing.cpu_count(), len(recordings))
+
+	### run every recording through the pool
+	jobs = [(vendor, inputDir, sessionNum, outputRoot, tableFormat, encodeOptions) for inputDir, sessionNum in recordings]
+	pool = multiprocessing.Pool(workers, initializer=setEncodeLimit,
+								initargs=(multiprocessing.Semaphore(max(maxEncodes, 1)),))
+	summaries = []
+	for summary in pool.imap(preprocessRecording, jobs):
+		print('{} ({:.1f} s): {}'.format(summary['status'].upper(), summary['seconds'], summary['inputDir']))
+		summaries.append(summary)
+	pool.close()
+	pool.join()
+
+	### write the summary
+	summary_df = pd.DataFrame(summaries, columns=['vendor', 'inputDir', 'sessionNum', 'outputDir', 'status', 'seconds', 'error'])
+	summaryPath = summaryPath or join(outputRoot, 'batchPreprocessing_summary.tsv')
+	summary_df.to_csv(summaryPath, sep='\t', index=False, float_format='%.1f')
+	print('{} of {} recordings preprocessed; summary saved to: {}'.format(
+			(summary_df['status'] == 'ok').sum(), summary_df.shape[0], summaryPath))
+
+	return summary_df
+
+
+if __name__ == '__main__':
+	# parse arguments
+	parser = argparse.ArgumentParser()
+	parser.add_argument('vendor', choices=vendors, help='manufacturer of the glasses the recordings were made with')
+	parser.add_argument('rawRoot', help='root dir to search for raw recordings')
+	parser.add_argument('outputRoot', help='output directory root. Each recording is written to its own dir within this directory')
+	parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of recordings to preprocess at once')
+	parser.add_argument('--maxEncodes', type=int, default=2, help='maximum number of concurrent ffmpeg encodes')
+	parser.add_argument('--tableFormat', choices=tableFormats, default=None, help='format for the output gaze tables')
+	parser.add_argument('--preset', choices=x264Presets, default=defaultEncodeOptions['preset'], help='x264 preset for the world camera videos')
+	parser.add_argument('--crf', type=int, default=defaultEncodeOptions['crf'], help='x264 constant rate factor (quality; lower is better)')
+	parser.add_argument('--threads', type=int, default=None, help='number of threads per ffmpeg encode (default: chosen by ffmpeg)')
+	parser.add_argument('--summary', default=None, help='path to the summary file (default: batchPreprocessing_summary.tsv in outputRoot)')
+	args = parser.parse_args()
+
+	# check if the raw root is valid
+	if not os.path.isdir(args.rawRoot):
+		print('Invalid raw data dir: {}'.format(args.rawRoot))
+		sys.exit()
+	else:
+		batchPreprocess(args.vendor, args.rawRoot, args.outputRoot, workers=args.workers, maxEncodes=args.maxEncodes,
+						tableFormat=args.tableFormat, encodeOptions={'preset': args.preset, 'crf': args.crf, 'threads': args.threads},
+						summaryPath=args.summary)
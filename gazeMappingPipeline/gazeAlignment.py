@@ -0,0 +1,147 @@
+"""
+Assign gaze samples to world camera frames
+
+All of the preprocessing scripts use alignToFrames to give each gaze sample the index of the
+world camera frame it belongs to. The available policies are:
+	- nearest:	the frame with the closest timestamp. The first and last frames extend half a
+				frame interval beyond their timestamps
+	- midpoint:	as nearest, but following Pupil Player's correlation: samples before the first
+				midpoint go to the first frame, and samples after the last midpoint are unmatched
+				(so the last frame never gets any samples). More appropriate for SW timestamps
+	- next:		the latest frame that started before the sample (i.e. up to the start of the next
+				frame). More appropriate for start of exposure (HW) timestamps. The last frame
+				extends one frame interval beyond its timestamp
+	- label:	the samples carry a frame label (e.g. the SMI frame counter), and the frame index
+				goes up by one every time the label changes
+
+Samples that fall outside of every frame are either clipped to the first/last frame, or flagged
+as unmatched with a frame index of -1.
+
+Run this script directly to benchmark the policies on simulated data, e.g.:
+	python gazeAlignment.py --nSamples 10000000
+"""
+
+# python 2/3 compatibility
+from __future__ import division
+from __future__ import print_function
+
+import time
+import argparse
+import numpy as np
+
+alignmentPolicies = ['nearest', 'midpoint', 'next', 'label']
+unmatchedModes = ['clip', 'flag']
+
+
+def frameBoundaries(frame_timestamps, policy='nearest'):
+	"""
+	Return the n+1 boundaries of the n frames for a time based policy:
+	frame i gets the samples t where bounds[i] < t <= bounds[i+1]
+	"""
+	ft = np.asarray(frame_timestamps, dtype=np.float64)
+	if ft.shape[0] < 2:
+		raise ValueError('Need at least 2 frame timestamps to align to')
+
+	if policy in ['nearest', 'midpoint']:
+		midpoints = (ft[:-1] + ft[1:]) / 2.
+		if policy == 'nearest':
+			return np.concatenate(([2*ft[0] - midpoints[0]], midpoints, [2*ft[-1] - midpoints[-1]]))
+		return np.concatenate(([-np.inf], midpoints, [midpoints[-1]]))
+	elif policy == 'next':
+		return np.concatenate((ft, [2*ft[-1] - ft[-2]]))
+	else:
+		raise ValueError('Unknown time alignment policy: {}'.format(policy))
+
+
+def labelFrameIndex(labels):
+	"""
+	Number the frames from 0, going up by one every time the label differs from the previous sample's
+	"""
+	labels = np.asarray(labels)
+	if labels.shape[0] == 0:
+		return np.zeros(0, dtype=np.int32)
+	labelChanged = labels[1:] != labels[:-1]
+	return np.concatenate(([0], np.cumsum(labelChanged))).astype(np.int32)
+
+
+def alignToFrames(samples, frame_timestamps=None, policy='nearest', unmatched='clip'):
+	"""
+	Return the frame index (int32) of every gaze sample
+
+	samples: sample timestamps (same units as frame_timestamps; need not be sorted),
+			or frame labels if policy is 'label'
+	frame_timestamps: sorted world camera frame timestamps. Optional for the 'label' policy,
+			where it is only used to find samples beyond the last frame
+	policy: one of alignmentPolicies (see above)
+	unmatched: 'clip' assigns samples outside every frame to the first/last frame,
+			'flag' gives them a frame index of -1
+	"""
+	if unmatched not in unmatchedModes:
+		raise ValueError('Unknown unmatched mode: {} (expected one of {})'.format(unmatched, unmatchedModes))
+
+	if policy == 'label':
+		frame_idx = labelFrameIndex(samples)
+		if frame_timestamps is None:
+			return frame_idx
+	else:
+		if frame_timestamps is None:
+			raise ValueError('The {} policy needs the frame timestamps'.format(policy))
+		bounds = frameBoundaries(frame_timestamps, policy)
+		frame_idx = (np.searchsorted(bounds, samples, side='left') - 1).astype(np.int32)
+
+	nFrames = len(frame_timestamps)
+	if unmatched == 'clip':
+		return np.clip(frame_idx, 0, nFrames-1, out=frame_idx)
+	frame_idx[(frame_idx < 0) | (frame_idx >= nFrames)] = -1
+	return frame_idx
+
+
+def alignmentDiagnostics(frame_idx, nFrames):
+	"""
+	Summarize an alignment (frame_idx as returned by alignToFrames with unmatched='flag';
+	clipped samples can't be told apart from matched ones)
+
+	Returns a dict with:
+		- nSamples, nUnmatched: total number of samples, and number not assigned to any frame
+		- nEmptyFrames: number of frames without any samples
+		- samplesPerFrame: histogram, where samplesPerFrame[k] is the number of frames with k samples
+	"""
+	frame_idx = np.asarray(frame_idx)
+	matched = (frame_idx >= 0) & (frame_idx < nFrames)
+	perFrame = np.bincount(frame_idx[matched], minlength=nFrames)
+	return {'nSamples': frame_idx.shape[0],
+			'nUnmatched': int((~matched).sum()),
+			'nEmptyFrames': int((perFrame == 0).sum()),
+			'samplesPerFrame': np.bincount(perFrame)}
+
+
+if __name__ == '__main__':
+	# parse arguments
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--nSamples', type=int, default=5000000, help='number of simulated gaze samples')
+	parser.add_argument('--gazeRate', type=float, default=120, help='gaze sampling rate (Hz)')
+	parser.add_argument('--fps', type=float, default=30, help='world camera frame rate (Hz)')
+	parser.add_argument('--repeats', type=int, default=3, help='number of timed runs per policy (best is reported)')
+	args = parser.parse_args()
+
+	### simulate jittered gaze and frame timestamps (ms)
+	rng = np.random.RandomState(0)
+	duration = args.nSamples / args.gazeRate * 1000
+	gaze_ts = np.sort(rng.uniform(0, duration, args.nSamples))
+	frame_ts = np.arange(0, duration, 1000 / args.fps) + rng.normal(0, 1, int(np.ceil(duration * args.fps / 1000)))
+	frame_ts = np.sort(frame_ts)
+	frameLabels = np.searchsorted(frame_ts, gaze_ts, side='right')
+	print('{} gaze samples, {} frames'.format(gaze_ts.shape[0], frame_ts.shape[0]))
+
+	### time each policy
+	for policy in alignmentPolicies:
+		samples = frameLabels if policy == 'label' else gaze_ts
+		times = []
+		for r in range(args.repeats):
+			startTime = time.time()
+			frame_idx = alignToFrames(samples, frame_ts, policy=policy, unmatched='flag')
+			times.append(time.time() - startTime)
+		diag = alignmentDiagnostics(frame_idx, frame_ts.shape[0])
+		print('{:>8}: {:.3f} s ({:.1f} M samples/s); {} unmatched, {} empty frames, samples per frame: {}'.format(
+				policy, min(times), gaze_ts.shape[0] / min(times) / 1e6, diag['nUnmatched'], diag['nEmptyFrames'],
+				dict((k, int(n)) for k, n in enumerate(diag['samplesPerFrame']) if n > 0)))
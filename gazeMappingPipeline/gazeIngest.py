@@ -0,0 +1,126 @@
+"""
+Read eye-tracking recordings into a common, in-memory GazeRecording
+
+Each supported manufacturer has a small adapter that reads the raw recording in place
+(using the formatting steps from the manufacturer-specific preprocessing script) and returns
+a GazeRecording. Recordings that have already been preprocessed can be loaded the same way.
+
+A GazeRecording can be written out as a preprocessed data dir, or handed straight to
+processRecording (processData.py), so that preprocessing and mapping can run as a single
+job without writing and re-reading the gaze tables in between.
+"""
+
+# python 2/3 compatibility
+from __future__ import division
+from __future__ import print_function
+
+import os
+from os.path import join
+from collections import OrderedDict
+import pandas as pd
+import cv2
+
+from gazeTables import readTable, applySchema, tableSchemas, writeGazeData, writeFrameTimestamps
+
+vendors = ['pupillabs', 'smi', 'tobii']
+
+
+class GazeRecording(object):
+	"""
+	Gaze data and world camera video from a single recording, in the common format:
+		- gaze: dict of column arrays, following the gazeData_world schema (see gazeTables.py)
+		- frame_timestamps: array of world camera frame timestamps (ms)
+		- videoPath: path to the world camera video that gaze['frame_idx'] refers to
+	"""
+	def __init__(self, gaze, frame_timestamps, videoPath):
+		# validate and cast the gaze columns to the schema dtypes
+		gaze_df = applySchema(pd.DataFrame(OrderedDict((c, gaze[c]) for c, dtype, required in tableSchemas['gazeData_world'])),
+								tableSchemas['gazeData_world'])
+		self.gaze = OrderedDict((c, gaze_df[c].values) for c in gaze_df.columns)
+		self.frame_timestamps = applySchema(pd.DataFrame({'timestamp': frame_timestamps}),
+											tableSchemas['frame_timestamps'], partial=True)['timestamp'].values
+		self.videoPath = videoPath
+
+	def __len__(self):
+		return self.gaze['timestamp'].shape[0]
+
+	def gazeDataFrame(self):
+		"""
+		Return the gaze data as a dataframe (columns share memory with the gaze arrays)
+		"""
+		return pd.DataFrame(self.gaze, copy=False)
+
+	def openVideo(self):
+		"""
+		Open the world camera video for reading
+		"""
+		vid = cv2.VideoCapture(self.videoPath)
+		if not vid.isOpened():
+			raise IOError('Could not open the world camera video: {}'.format(self.videoPath))
+		return vid
+
+	def write(self, outputDir, tableFormat=None):
+		"""
+		Write the gaze data and frame timestamps to outputDir, as in a preprocessed data dir
+		(the video is not copied)
+		"""
+		if not os.path.isdir(outputDir):
+			os.makedirs(outputDir)
+		writeGazeData(outputDir, self.gaze, tableFormat)
+		writeFrameTimestamps(outputDir, self.frame_timestamps, tableFormat)
+
+
+def loadPreprocessed(preprocessedDir):
+	"""
+	Load a preprocessed data dir (the output of any of the preprocessing scripts)
+	"""
+	gaze_df = readTable(join(preprocessedDir, 'gazeData_world'))
+	frame_ts_df = readTable(join(preprocessedDir, 'frame_timestamps'), columns=['timestamp'])
+	return GazeRecording(gaze_df, frame_ts_df['timestamp'].values, join(preprocessedDir, 'worldCamera.mp4'))
+
+
+### Manufacturer adapters: read the raw recording in place, using the source world camera video
+def readPupilLabs(inputDir):
+	"""
+	Read a raw Pupil Labs recording dir
+	"""
+	import pl_preprocessing
+	gaze, frame_timestamps = pl_preprocessing.formatGazeData(inputDir)
+	return GazeRecording(gaze, frame_timestamps, join(inputDir, 'world.mp4'))
+
+
+def readSMI(inputDir, sessionNum):
+	"""
+	Read one session from a dir of SMI exports (see smi_preprocessing.py)
+	"""
+	import smi_preprocessing
+	from videoTools import getVidFrameTimestamps
+	vidPath, rawPath = smi_preprocessing.findSMI_recording(inputDir, sessionNum)
+	gaze_df = smi_preprocessing.formatGazeData(rawPath, vidPath)
+	return GazeRecording(gaze_df, getVidFrameTimestamps(vidPath), vidPath)
+
+
+def readTobii(inputDir):
+	"""
+	Read a raw Tobii recording dir
+	"""
+	import tobii_preprocessing
+	gaze_df, frame_timestamps = tobii_preprocessing.formatGazeData(inputDir)
+	return GazeRecording(gaze_df, frame_timestamps, join(inputDir, 'fullstream.mp4'))
+
+
+def readRecording(vendor, inputDir, sessionNum=None):
+	"""
+	Read the raw recording in inputDir with the adapter for the given vendor (one of vendors).
+	sessionNum is required for SMI
+	"""
+	if vendor == 'pupillabs':
+		return readPupilLabs(inputDir)
+	elif vendor == 'smi':
+		if sessionNum is None:
+			raise ValueError('SMI recordings need a session number')
+		return readSMI(inputDir, sessionNum)
+	elif vendor == 'tobii':
+		return readTobii(inputDir)
+	else:
+		raise ValueError('Unknown vendor: {} (expected one of {})'.format(vendor, vendors))
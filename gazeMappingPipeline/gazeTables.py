@@ -0,0 +1,282 @@
+"""
+Read and write the intermediate gaze tables passed between pipeline stages
+(e.g. gazeData_world, frame_timestamps, gazeData_mapped, gazeData_calibration)
+
+Tables are referred to by their path without an extension (e.g. <dir>/gazeData_world), and
+can be stored in any of these formats:
+	- feather:	columnar binary, uncompressed, read back memory-mapped (requires pyarrow; default)
+	- parquet:	columnar binary, compressed (requires pyarrow)
+	- npz:		numpy archive of the columns (used by default if pyarrow is not installed)
+	- tsv:		tab-separated text, as written by earlier versions of the pipeline
+
+Readers auto-detect whichever format exists, so earlier tsv outputs can still be read.
+
+Tables with a schema in tableSchemas (matched on the file name) are validated and cast to the
+schema dtypes whenever they are written or read, so every vendor's data comes back with the same
+columns and compact dtypes (e.g. int32 frame indices, float32 coordinates).
+"""
+
+# python 2/3 compatibility
+from __future__ import division
+from __future__ import print_function
+
+import os
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+try:
+	import pyarrow
+	import pyarrow.feather as feather
+	import pyarrow.parquet as parquet
+	HAS_PYARROW = True
+except ImportError:
+	HAS_PYARROW = False
+
+### Configuration vars
+tableFormats = ['feather', 'parquet', 'npz', 'tsv']
+defaultFormat = 'feather' if HAS_PYARROW else 'npz'
+tsvFloatFormat = '%.3f'
+
+### Table schemas: (column, dtype, required), in column order
+# Timestamps stay float64 (ms; large offsets), coordinates are float32.
+# Confidence is float32, since Pupil Labs reports it on a 0-1 scale (Tobii and SMI use 0 or 1)
+tableSchemas = {
+	'frame_timestamps': [('frameNum', 'int32', True),
+						('timestamp', 'float64', True)],
+
+	'gazeData_world': [('timestamp', 'float64', True),
+						('frame_idx', 'int32', True),
+						('confidence', 'float32', True),
+						('norm_pos_x', 'float32', True),
+						('norm_pos_y', 'float32', True)],
+
+	# mapped to the reference image (gazeMappingPipeline), or to the border and calibration grid (scripts)
+	'gazeData_mapped': [('worldFrame', 'int32', True),
+						('gaze_ts', 'float64', True),
+						('confidence', 'float32', True),
+						('world_gazeX', 'float32', True),
+						('world_gazeY', 'float32', True),
+						('ref_gazeX', 'float32', False),
+						('ref_gazeY', 'float32', False),
+						('border_gazeX', 'float32', False),
+						('border_gazeY', 'float32', False),
+						('calibGrid_gazeX', 'float32', False),
+						('calibGrid_gazeY', 'float32', False)],
+
+	'gazeData_calibration': [('trial', 'int16', True),
+							('ptIdx', 'int16', True),
+							('col', 'int8', True),
+							('row', 'int8', True),
+							('trial_ts', 'float32', True),
+							('task_ts', 'float64', True),
+							('gaze_ts', 'float64', True),
+							('worldFrame', 'int32', True),
+							('confidence', 'float32', True),
+							('world_gazeX', 'float32', True),
+							('world_gazeY', 'float32', True),
+							('border_gazeX', 'float32', True),
+							('border_gazeY', 'float32', True),
+							('calibGrid_gazeX', 'float32', True),
+							('calibGrid_gazeY', 'float32', True),
+							('distance', 'float32', True),
+							('angle', 'float32', True)],
+
+	'calibrationSummary': [('trial', 'int16', True),
+							('ptIdx', 'int16', True),
+							('percentValid', 'float32', True),
+							('centX', 'float32', True),
+							('centY', 'float32', True),
+							('centDist', 'float32', True),
+							('centAngle', 'float32', True),
+							('RMS', 'float32', True)]}
+
+
+def splitTablePath(path):
+	"""
+	Split a table path into (base path, format); format is None if the path has no known extension
+	"""
+	base, ext = os.path.splitext(path)
+	if ext[1:] in tableFormats:
+		return base, ext[1:]
+	return path, None
+
+
+def findTable(path):
+	"""
+	Return the path to the stored table (in any format), or None if it doesn't exist.
+	Binary formats are preferred over tsv if more than one exists
+	"""
+	base, fmt = splitTablePath(path)
+	for thisFmt in ([fmt] if fmt else tableFormats):
+		if os.path.exists(base + '.' + thisFmt):
+			return base + '.' + thisFmt
+	return None
+
+
+def getSchema(path):
+	"""
+	Return the schema for the table stored at path (matched on the file name), or None
+	"""
+	return tableSchemas.get(os.path.basename(splitTablePath(path)[0]))
+
+
+def applySchema(df, schema, partial=False):
+	"""
+	Validate df against the schema, and return it with the columns in schema order and
+	cast to the schema dtypes. If partial is True, only the columns present in df are
+	checked (e.g. when only some columns were read), in any order.
+
+	If df already has the schema dtypes (and order), it is returned as is, without copying;
+	otherwise a new dataframe is returned.
+
+	Raises ValueError if a required column is missing, a column is not in the schema, or
+	a column can't be cast without losing data (e.g. NaN or fractional values in an int column)
+	"""
+	schemaCols = [c for c, dtype, required in schema]
+	unknown = [c for c in df.columns if c not in schemaCols]
+	if len(unknown) > 0:
+		raise ValueError('Columns not in the table schema: {}'.format(unknown))
+	missing = [c for c, dtype, required in schema if required and c not in df.columns]
+	if len(missing) > 0 and not partial:
+		raise ValueError('Missing required columns: {}'.format(missing))
+
+	# nothing to cast
+	present = [(c, dtype) for c, dtype, required in schema if c in df.columns]
+	if all(df[c].dtype == np.dtype(dtype) for c, dtype in present) and (partial or [c for c, dtype in present] == list(df.columns)):
+		return df
+
+	typed = OrderedDict()
+	for c, dtype, required in schema:
+		if c not in df.columns:
+			continue
+		values = df[c].values
+		if np.dtype(dtype).kind in 'iu':
+			info = np.iinfo(dtype)
+			if np.issubdtype(values.dtype, np.floating) and not np.all(np.isfinite(values) & (values == np.round(values))):
+				raise ValueError('Column {} has missing or non-integer values; cannot store as {}'.format(c, dtype))
+			if values.shape[0] > 0 and (values.min() < info.min or values.max() > info.max):
+				raise ValueError('Column {} has values outside the range of {}'.format(c, dtype))
+		typed[c] = values.astype(dtype, copy=False)
+
+	return pd.DataFrame(typed, index=df.index)
+
+
+def castArrowTable(table, schema):
+	"""
+	Cast the columns of an Arrow table to the schema dtypes, before it is converted to a
+	dataframe (columns that already have the schema dtype are left as they are, without copying).
+	Columns not in the schema are left for applySchema to reject.
+
+	Raises ValueError if a column can't be cast without losing data
+	"""
+	dtypes = dict((c, dtype) for c, dtype, required in schema)
+	for i, c in enumerate(table.column_names):
+		if c not in dtypes:
+			continue
+		arrowType = pyarrow.from_numpy_dtype(np.dtype(dtypes[c]))
+		if table.schema.field(i).type != arrowType:
+			try:
+				table = table.set_column(i, c, table.column(i).cast(arrowType))
+			except pyarrow.ArrowInvalid as e:
+				raise ValueError('Column {} cannot be stored as {} ({})'.format(c, dtypes[c], e))
+	return table
+
+
+def writeTable(df, path, fmt=None):
+	"""
+	Write the dataframe to path in the given format (default: defaultFormat, or the
+	format given by the path's extension). Tables with a schema are validated and cast
+	first (see applySchema). Copies of the same table in other formats are
+	removed, so readers never pick up stale data.
+
+	Returns the path written to
+	"""
+	base, pathFmt = splitTablePath(path)
+	fmt = fmt or pathFmt or defaultFormat
+	if fmt not in tableFormats:
+		raise ValueError('Unknown table format: {} (expected one of {})'.format(fmt, tableFormats))
+	if fmt in ['feather', 'parquet'] and not HAS_PYARROW:
+		raise ImportError('Writing {} tables requires pyarrow'.format(fmt))
+
+	schema = getSchema(base)
+	if schema is not None:
+		df = applySchema(df, schema)
+
+	df = df.reset_index(drop=True)
+	tablePath = base + '.' + fmt
+	if fmt == 'feather':
+		# written as a single chunk, so the columns can be read back without copying (see readTable).
+		# The file is replaced rather than overwritten, in case it is still memory-mapped by a reader
+		feather.write_feather(df, tablePath + '.tmp', compression='uncompressed', chunksize=max(df.shape[0], 1))
+		os.replace(tablePath + '.tmp', tablePath)
+	elif fmt == 'parquet':
+		df.to_parquet(tablePath, index=False)
+	elif fmt == 'npz':
+		with open(tablePath, 'wb') as f:
+			np.savez(f, _columns=np.array(df.columns, dtype=str), **{c: df[c].values for c in df.columns})
+	elif fmt == 'tsv':
+		df.to_csv(tablePath, sep='\t', index=False, float_format=tsvFloatFormat)
+
+	# remove other copies of this table
+	for otherFmt in tableFormats:
+		if otherFmt != fmt and os.path.exists(base + '.' + otherFmt):
+			os.remove(base + '.' + otherFmt)
+
+	return tablePath
+
+
+def readTable(path, columns=None):
+	"""
+	Read the table stored at path (in any format) into a dataframe, optionally
+	only loading the specified columns. Tables with a schema are validated and cast
+	to the schema dtypes (see applySchema)
+
+	feather tables are memory-mapped: columns that are stored with the schema dtype (as
+	written by writeTable) are read-only views of the file, rather than copies in memory
+	"""
+	tablePath = findTable(path)
+	if tablePath is None:
+		raise IOError('No table found at: {}'.format(path))
+	fmt = splitTablePath(tablePath)[1]
+	schema = getSchema(tablePath)
+
+	if fmt == 'feather':
+		table = feather.read_table(tablePath, columns=columns, memory_map=True)
+		if schema is not None:
+			table = castArrowTable(table, schema)
+		df = pd.DataFrame(OrderedDict((c, table.column(i).to_numpy()) for i, c in enumerate(table.column_names)), copy=False)
+	elif fmt == 'parquet':
+		df = pd.read_parquet(tablePath, columns=columns)
+	elif fmt == 'npz':
+		with np.load(tablePath) as npz:
+			df = pd.DataFrame({c: npz[c] for c in (columns or [str(c) for c in npz['_columns']])})
+	elif fmt == 'tsv':
+		df = pd.read_table(tablePath, sep='\t', usecols=columns)
+
+	if schema is not None:
+		df = applySchema(df, schema, partial=columns is not None)
+
+	if columns is not None and list(df.columns) != list(columns):
+		df = df[columns]
+	return df
+
+
+def writeGazeData(outputDir, gaze, fmt=None):
+	"""
+	Write the standard gaze table (gazeData_world) to outputDir in one call
+
+	gaze: dataframe or dict of arrays with timestamp (ms), frame_idx, confidence,
+	and norm_pos_x, norm_pos_y (normalized world camera coords, origin at the top-left)
+	"""
+	gaze_df = pd.DataFrame(OrderedDict((c, np.asarray(gaze[c])) for c, dtype, required in tableSchemas['gazeData_world']))
+	return writeTable(gaze_df, os.path.join(outputDir, 'gazeData_world'), fmt)
+
+
+def writeFrameTimestamps(outputDir, frame_timestamps, fmt=None):
+	"""
+	Write the world camera frame timestamps (ms) to outputDir, numbering the frames from 1
+	"""
+	frame_ts_df = pd.DataFrame(OrderedDict([('frameNum', np.arange(1, len(frame_timestamps)+1)),
+											('timestamp', np.asarray(frame_timestamps))]))
+	return writeTable(frame_ts_df, os.path.join(outputDir, 'frame_timestamps'), fmt)
@@ -7,11 +7,15 @@ Once preprocessing is completed, this script can be used to loop through
 every frame of the worldCamera.mp4 video, and try to map the gaze coordinates
 from the world coordinate system, to the reference image
 
+Alternatively, pass --vendor to read a raw recording directly (see gazeIngest.py) and
+run preprocessing and processing as one step, on the source world camera video
+
 Output will contain:
 	- world_gaze.mp4:		world video w/ gaze points overlaid
 	- ref_gaze.mp4:		video of ref image w/ gaze points overlaid
 	- ref2world_mapping.mp4 	video of reference image projected back into world video
-	- gazeData_mapped.tsv:	gazeData mapped to both coordinate systems
+	- gazeData_mapped.<fmt>:	gazeData mapped to both coordinate systems (feather by default; see gazeTables.py)
+	- frameLog.tsv:		per-frame record of how each frame was handled (matched, skipped, reused)
 """
 
 # python 2/3 compatibility
@@ -28,9 +32,21 @@ import pandas as pd
 from os.path import join
 import cv2
 
+from gazeTables import writeTable, findTable, tableFormats
+from gazeIngest import GazeRecording, loadPreprocessed, readRecording, vendors
+
 OPENCV3 = (cv2.__version__.split('.')[0] == '3')
 print("OPENCV version " + cv2.__version__)
 
+# default feature matching settings. A profile written by tuneMatching.py can override these
+defaultMatchParams = {'trees': 5,				# FLANN kd-trees
+						'checks': 10,			# FLANN leaves visited per query; lower = faster, less accurate
+						'distance_ratio': 0.5,	# 0-1; lower values more conservative
+						'min_good_matches': 4,	# matches needed to return any points from findMatches
+						'min_matches': 10,		# matches needed (more than) to attempt a homography on a frame
+						'descriptor_mode': 'float',	# 'float' (raw SIFT), 'uint8' (quantized), or 'pca' (projected, see below)
+						'pca_components': 32}	# dimensions kept in 'pca' mode
+
 def copyPreprocessing(preprocessedDir, condition):
 	"""
 	copy the data from the preprocessing dir to a new dir based on condition name
@@ -41,29 +57,162 @@ def copyPreprocessing(preprocessedDir, condition):
 	if not os.path.isdir(outputDir):
 		os.makedirs(outputDir)
 
-	# copy files
-	for f in ['worldCamera.mp4', 'gazeData_world.tsv', 'frame_timestamps.tsv']:
-		src = join(preprocessedDir, f)
-		shutil.copy(src, outputDir)
+	# copy files (the gaze tables in whichever format they were written)
+	shutil.copy(join(preprocessedDir, 'worldCamera.mp4'), outputDir)
+	for f in ['gazeData_world', 'frame_timestamps']:
+		shutil.copy(findTable(join(preprocessedDir, f)), outputDir)
+
+
+def createFeatureDetector(nfeatures=0, contrastThreshold=0.04):
+	"""
+	Create a SIFT feature detector. nfeatures=0 keeps all features
+	"""
+	if OPENCV3:
+		return cv2.xfeatures2d.SIFT_create(nfeatures=nfeatures, contrastThreshold=contrastThreshold)
+	else:
+		return cv2.SIFT(nfeatures=nfeatures, contrastThreshold=contrastThreshold)
+
+
+def updateFeatureBudget(budget, frameTime, numInliers):
+	"""
+	Adjust the frame feature detection and matching settings stored in budget
+	to hold the per-frame processing time near budget['targetTime'] (seconds)
+		- over budget: fewer features, higher contrast threshold, fewer FLANN checks
+		- under budget, or fewer than budget['minInliers'] inliers on a matched frame: the reverse
 
+	numInliers should be None on frames where the reference image was not found, so that
+	frames looking away from the reference only count toward the time target
 
-def findMatches(img1_kp, img1_des, img2_kp, img2_des):
+	Returns True if the feature detector needs to be recreated with the new settings
+	"""
+	nfeatures = budget['nfeatures']
+	contrastThreshold = budget['contrastThreshold']
+	checks = budget['checks']
+
+	tooFewInliers = (numInliers is not None) and (numInliers < budget['minInliers'])
+	if tooFewInliers or (frameTime < 0.8*budget['targetTime']):
+		nfeatures = min(int(nfeatures * 1.2), 5000)
+		contrastThreshold = max(contrastThreshold * 0.9, 0.01)
+		checks = min(int(np.ceil(checks * 1.5)), 128)
+	elif frameTime > 1.1*budget['targetTime']:
+		nfeatures = max(int(nfeatures * 0.8), 200)
+		contrastThreshold = min(contrastThreshold * 1.1, 0.1)
+		checks = max(int(checks / 1.5), 4)
+
+	detectorChanged = ((nfeatures != budget['nfeatures']) or (contrastThreshold != budget['contrastThreshold']))
+	budget['nfeatures'] = nfeatures
+	budget['contrastThreshold'] = contrastThreshold
+	budget['checks'] = checks
+
+	return detectorChanged
+
+
+def loadMatchParams(profilePath=None):
+	"""
+	Return the feature matching settings: the defaults, updated with the
+	settings stored in the matching profile (written by tuneMatching.py), if supplied
+	"""
+	matchParams = defaultMatchParams.copy()
+	if profilePath is not None:
+		with open(profilePath, 'r') as f:
+			matchParams.update(json.load(f)['matchParams'])
+
+	return matchParams
+
+
+def fitDescriptorPCA(des, nComponents):
+	"""
+	Find the PCA projection (mean, and top nComponents basis vectors) of a set of descriptors
+	"""
+	mean = np.mean(des, axis=0)
+	u, s, vt = np.linalg.svd(des - mean, full_matrices=False)
+	return {'mean': mean.astype(np.float32), 'basis': vt[:nComponents].astype(np.float32)}
+
+
+def compactDescriptors(des, descriptorMode, pca=None):
+	"""
+	Convert SIFT descriptors to the representation used for matching and caching
+		- 'float': unchanged (128 x float32)
+		- 'uint8': quantized to 128 x uint8. SIFT descriptor values are already whole numbers
+		  between 0-255, so this is lossless and uses 1/4 of the memory. This only saves storage
+		  (e.g. the reference cache): FLANN kd-trees search float32 descriptors, so matching is
+		  the same as in 'float' mode
+		- 'pca': projected onto the PCA basis (see fitDescriptorPCA) fit on the reference image.
+		  Fewer dimensions = faster nearest neighbour search, at some cost in distinctiveness
+	"""
+	if des is None or descriptorMode == 'float':
+		return des
+	elif descriptorMode == 'uint8':
+		return np.clip(np.round(des), 0, 255).astype(np.uint8)
+	elif descriptorMode == 'pca':
+		return np.dot(des - pca['mean'], pca['basis'].T).astype(np.float32)
+	else:
+		raise ValueError('Unknown descriptor mode: {}'.format(descriptorMode))
+
+
+def loadReferenceFeatures(referenceImage_path, refImg, featureDetect, matchParams, cacheDir):
+	"""
+	Find the keypoints and descriptors (in matchParams['descriptor_mode']) for the reference image
+
+	Results are cached in cacheDir and reused as long as the reference image and
+	descriptor settings have not changed
+
+	Returns keypoints, descriptors, and the PCA projection (None unless in 'pca' mode)
+	"""
+	descriptorMode = matchParams['descriptor_mode']
+	cachePath = join(cacheDir, 'referenceFeatures_{}.npz'.format(descriptorMode))
+	refStat = os.stat(referenceImage_path)
+	cacheKey = np.array([refStat.st_size, refStat.st_mtime, matchParams['pca_components']])
+
+	# reuse the cached features, if valid
+	if os.path.exists(cachePath):
+		# read the arrays out while the file is open, so it is closed before the cache is rewritten
+		with np.load(cachePath) as cache:
+			cached = {k: cache[k] for k in cache.files} if np.array_equal(cache['cacheKey'], cacheKey) else None
+		if cached is not None:
+			kp = [cv2.KeyPoint(x, y, size, angle, response, int(octave), int(class_id))
+					for x, y, size, angle, response, octave, class_id in cached['keypoints']]
+			pca = {'mean': cached['pcaMean'], 'basis': cached['pcaBasis']} if descriptorMode == 'pca' else None
+			print('Reference Image: loaded {} cached keypoints'.format(len(kp)))
+			return kp, cached['descriptors'], pca
+
+	# otherwise, find them
+	kp, des = featureDetect.detectAndCompute(refImg, None)
+	pca = fitDescriptorPCA(des, matchParams['pca_components']) if descriptorMode == 'pca' else None
+	des = compactDescriptors(des, descriptorMode, pca)
+	print('Reference Image: found {} keypoints'.format(len(kp)))
+
+	np.savez(cachePath, cacheKey=cacheKey, descriptors=des,
+			keypoints=np.array([[k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave, k.class_id] for k in kp]),
+			pcaMean=pca['mean'] if pca else np.array([]),
+			pcaBasis=pca['basis'] if pca else np.array([]))
+
+	return kp, des, pca
+
+
+def findMatches(img1_kp, img1_des, img2_kp, img2_des, matchParams=None):
 	"""
 	Find the matches between the descriptors for two images
 		Inputs: 	keypoints, descriptors each image
 		Output: 	2D coords of quaifying matches on img1, 2D coords of qualifying matches on img2
+
+	matchParams: dict of matching settings (see defaultMatchParams)
 	"""
+	if matchParams is None:
+		matchParams = defaultMatchParams
+
 	# Match settings
-	min_match_count = 50
-	min_good_matches = 4
+	min_good_matches = matchParams['min_good_matches']
 	num_matches = 2
 	FLANN_INDEX_KDTREE = 0
-	distance_ratio = 0.5				# 0-1; lower values more conservative
-	index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=5)
-	search_params = dict(checks=10)		# lower = faster, less accurate
+	distance_ratio = matchParams['distance_ratio']
+	index_params = dict(algorithm=FLANN_INDEX_KDTREE, trees=matchParams['trees'])
+	search_params = dict(checks=matchParams['checks'])
 	matcher = cv2.FlannBasedMatcher(index_params, search_params)
 
-	# find all matches
+	# find all matches (FLANN kd-trees need float32 descriptors; no copy if they already are)
+	img1_des = np.asarray(img1_des, dtype=np.float32)
+	img2_des = np.asarray(img2_des, dtype=np.float32)
 	matches = matcher.knnMatch(img1_des, img2_des, k=num_matches)
 
 	# filter out cases where the 2 matches (best guesses) are too close to each other
@@ -119,15 +268,131 @@ def projectImage2D(origFrame, transform2D, newImage):
 	return newFrame
 
 
-def processRecording(preprocessedDir, outputDir, referenceImage_path):
+def reprojectionError(src_pts, dst_pts, transform2D):
 	"""
-	Read preprocessed data from preprocessedDir, save all output in outputDir
+	Distance (pixels) between each dst point and its src point mapped through the transformation matrix
+	"""
+	projected = cv2.perspectiveTransform(src_pts.reshape(-1,1,2), transform2D)
+	return np.linalg.norm(projected - dst_pts.reshape(-1,1,2), axis=2).ravel()
+
+
+def estimateHomography(src_pts, dst_pts, priorTransform=None, robustMethod='ransac',
+						reprojThresh=5.0, acceptError=1.5, minInlierRatio=0.6, refineIters=3):
+	"""
+	Find the homography mapping src_pts to dst_pts
+
+	If a prior homography is supplied (e.g. from the previously matched frame), try it first:
+		- 'prior': accept as-is if enough matches agree with it (error < reprojThresh), and their mean error is below acceptError
+		- 'refined': otherwise, refit by least squares on those inliers (up to refineIters times) and re-test
+	If that fails (or there is no prior), fit from scratch with RANSAC, or with USAC (MAGSAC) if
+	robustMethod is 'usac' and this version of openCV supports it
+
+	Returns:
+		- the homography (None if it could not be estimated)
+		- dict w/ the method used, the inlier ratio, and the mean reprojection error of the inliers
+	"""
+	src_pts = src_pts.reshape(-1,1,2)
+	dst_pts = dst_pts.reshape(-1,1,2)
+
+	# fast path: test (and refine) the prior
+	if priorTransform is not None:
+		transform2D = priorTransform
+		for i in range(refineIters + 1):
+			err = reprojectionError(src_pts, dst_pts, transform2D)
+			inliers = err < reprojThresh
+			inlierRatio = np.mean(inliers)
+			if (inlierRatio < minInlierRatio) or (np.sum(inliers) < 4):
+				break
+
+			meanErr = np.mean(err[inliers])
+			if meanErr < acceptError:
+				method = 'prior' if i == 0 else 'refined'
+				return transform2D, {'method': method, 'inlierRatio': inlierRatio, 'reprojError': meanErr}
+
+			# least squares refit on the inliers only
+			if i < refineIters:
+				transform2D, mask = cv2.findHomography(src_pts[inliers], dst_pts[inliers], 0)
+				if transform2D is None:
+					break
+
+	# full robust estimation
+	if (robustMethod == 'usac') and hasattr(cv2, 'USAC_MAGSAC'):
+		method, flag = 'usac', cv2.USAC_MAGSAC
+	else:
+		method, flag = 'ransac', cv2.RANSAC
+	transform2D, mask = cv2.findHomography(src_pts, dst_pts, flag, reprojThresh)
+	if transform2D is None:
+		return None, {'method': method, 'inlierRatio': 0, 'reprojError': np.nan}
+
+	inliers = mask.ravel().astype(bool)
+	err = reprojectionError(src_pts, dst_pts, transform2D)
+	return transform2D, {'method': method, 'inlierRatio': np.mean(inliers), 'reprojError': np.mean(err[inliers])}
+
+
+def assessFrameQuality(frame, anchorSmall, blurThresh, sceneThresh):
+	"""
+	Cheap quality check on a downscaled copy of the frame, run before any feature matching
+		- sharpness: variance of the Laplacian. Low on motion-blurred or textureless frames
+		- sceneDiff: mean absolute difference (grayscale levels) from the last frame that went through full matching
+
+	Returns:
+		- decision: 'skip' (hopeless frame), 'static' (near-identical to last matched frame), or 'match'
+		- sharpness, sceneDiff
+		- the downscaled grayscale frame (to be stored as the next anchor)
+	"""
+	small = cv2.resize(frame, None, fx=0.25, fy=0.25, interpolation=cv2.INTER_AREA)
+	small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+
+	sharpness = cv2.Laplacian(small, cv2.CV_64F).var()
+	if anchorSmall is None:
+		sceneDiff = np.nan
+	else:
+		sceneDiff = np.mean(cv2.absdiff(small, anchorSmall))
+
+	if sharpness < blurThresh:
+		decision = 'skip'
+	elif sceneDiff < sceneThresh:		# always False when there is no anchor yet (NaN)
+		decision = 'static'
+	else:
+		decision = 'match'
+
+	return decision, sharpness, sceneDiff, small
+
+
+def processRecording(preprocessedDir, outputDir, referenceImage_path, blurThresh=0, sceneThresh=0, gazeOnly=False,
+						robustMethod='ransac', frameBudget=None, minInliers=20, matchProfile=None, descriptorMode=None,
+						tableFormat=None):
+	"""
+	Read preprocessed data from preprocessedDir, save all output in outputDir.
+	preprocessedDir can also be a GazeRecording (see gazeIngest.py), which is used in place
 
 	On each frame of worldCamera.mp4, look for the matches with the specified
 	referenceImage
 
 	If sufficient matches found, map the gaze data from the world camera
 	video coordinate system to the reference image coordinate system
+
+	Frames can optionally pass a cheap quality check before matching (see assessFrameQuality).
+	Frames sharper than blurThresh that differ from the last matched frame by more than
+	sceneThresh get full matching; blurry frames are skipped, and near-identical frames reuse
+	the last result. Both thresholds default to 0, which disables that check (it isn't run at all,
+	and sharpness/sceneDiff are left empty in the frame log), so every frame is matched unless a
+	threshold is set (e.g. blurThresh=25, sceneThresh=1.0).
+
+	If gazeOnly is True, frames without any valid gaze sample (confidence > 0) are not
+	matched at all; they are still written, unmapped, to the output videos.
+
+	The homography found on the last good frame is used as the starting point on the
+	next one (see estimateHomography). robustMethod ('ransac' or 'usac') sets the fallback.
+
+	If frameBudget (ms) is given, the number of SIFT features, SIFT contrast threshold and FLANN
+	checks are adjusted after every matched frame to hold the matching time near that target, while
+	keeping at least minInliers homography inliers (see updateFeatureBudget). Otherwise SIFT runs with
+	its default settings.
+
+	matchProfile: optional path to a matching profile written by tuneMatching.py
+	descriptorMode: overrides the profile's descriptor_mode (see compactDescriptors)
+	tableFormat: storage format for gazeData_mapped (see gazeTables.py)
 	"""
 
 	### SetUp inputs/outputs
@@ -139,7 +404,14 @@ def processRecording(preprocessedDir, outputDir, referenceImage_path):
 	shutil.copy(referenceImage_path, outputDir)
 
 	# load gaze data
-	gazeWorld_df = pd.read_table(join(preprocessedDir, 'gazeData_world.tsv'), sep='\t')
+	if isinstance(preprocessedDir, GazeRecording):
+		recording = preprocessedDir
+	else:
+		recording = loadPreprocessed(preprocessedDir)
+	gazeWorld_df = recording.gazeDataFrame()
+
+	# frames that have at least one valid gaze sample
+	validGazeFrames = set(gazeWorld_df.loc[gazeWorld_df['confidence'] > 0, 'frame_idx'].astype(int))
 
 	### Load the reference image
 	refImg = cv2.imread(join(outputDir, referenceImage_path.split('/')[-1]))
@@ -148,19 +420,18 @@ def processRecording(preprocessedDir, outputDir, referenceImage_path):
 
 	### Prep the video data #######################################
 	# load the video, get parameters
-	vid = cv2.VideoCapture(join(preprocessedDir, 'worldCamera.mp4'))
+	vid = recording.openVideo()
 	if OPENCV3:
 		totalFrames = vid.get(cv2.CAP_PROP_FRAME_COUNT)
 		vidSize = (int(vid.get(cv2.CAP_PROP_FRAME_WIDTH)), int(vid.get(cv2.CAP_PROP_FRAME_HEIGHT)))
 		fps = vid.get(cv2.CAP_PROP_FPS)
 		vidCodec = cv2.VideoWriter_fourcc(*'mp4v')
-		featureDetect = cv2.xfeatures2d.SIFT_create()
 	else:
 		totalFrames = vid.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
 		vidSize = (int(vid.get(cv2.cv.CV_CAP_PROP_FRAME_WIDTH)), int(vid.get(cv2.cv.CV_CAP_PROP_FRAME_HEIGHT)))
 		fps = vid.get(cv2.cv.CV_CAP_PROP_FPS)
 		vidCodec = cv2.cv.CV_FOURCC(*'mp4v')
-		featureDetect = cv2.SIFT()
+	featureDetect = createFeatureDetector()
 
 	# world camera output video
 	vidOut_world_fname = join(outputDir, 'world_gaze.m4v')
@@ -177,9 +448,22 @@ def processRecording(preprocessedDir, outputDir, referenceImage_path):
 	vidOut_ref2world = cv2.VideoWriter()
 	vidOut_ref2world.open(vidOut_ref2world_fname, vidCodec, fps, vidSize, True)
 
+	# frame feature detection/matching settings
+	matchParams = loadMatchParams(matchProfile)
+	if descriptorMode is not None:
+		matchParams['descriptor_mode'] = descriptorMode
+	print('Matching settings: {}'.format(matchParams))
+
 	### find keypoints, descriptors for the reference image
-	refImg_kp, refImg_des = featureDetect.detectAndCompute(refImg, None)
-	print('Reference Image: found {} keypoints'.format(len(refImg_kp)))
+	refImg_kp, refImg_des, descriptorPCA = loadReferenceFeatures(referenceImage_path, refImg, featureDetect, matchParams, outputDir)
+	print('Reference Image: descriptors use {:.1f} KB'.format(refImg_des.nbytes/1024))
+	refImg_des = np.asarray(refImg_des, dtype=np.float32)		# matched as float32 (see findMatches); convert once
+	if frameBudget is None:
+		featureBudget = {'nfeatures': 0, 'contrastThreshold': 0.04, 'checks': matchParams['checks']}
+	else:
+		featureBudget = {'nfeatures': 1000, 'contrastThreshold': 0.04, 'checks': matchParams['checks'],
+						'targetTime': frameBudget/1000, 'minInliers': minInliers}
+		featureDetect = createFeatureDetector(featureBudget['nfeatures'], featureBudget['contrastThreshold'])
 
 	### Loop over video frames #########################################################
 	framesToUse = np.arange(0, 10000, 1)
@@ -189,6 +473,13 @@ def processRecording(preprocessedDir, outputDir, referenceImage_path):
 	frameProcessing_startTime = time.time()
 	frameCounter = 0
 
+	# state for the frame quality check (only run if a threshold is set)
+	qualityCheck = (blurThresh > 0) or (sceneThresh > 0)
+	anchorSmall = None			# downscaled copy of the last frame that went through full matching
+	anchorFrame = None			# processed output of that frame
+	homographyPrior = None		# ref2world transform from the last good match
+	frameLog = []				# per-frame record of how each frame was handled
+
 	# error debugging
 	logFile = open(join(outputDir, 'processing_log.txt'), 'w')
 
@@ -202,8 +493,50 @@ def processRecording(preprocessedDir, outputDir, referenceImage_path):
 			# make copy of the reference image (will be used to write a frame to the reference image output videos)
 			ref_frame = refImgColor.copy()
 
+			# decide whether this frame is worth full matching
+			if gazeOnly and (frameCounter not in validGazeFrames):
+				decision, sharpness, sceneDiff = 'noGaze', np.nan, np.nan
+			elif not qualityCheck:
+				decision, sharpness, sceneDiff, small = 'match', np.nan, np.nan, None
+			else:
+				decision, sharpness, sceneDiff, small = assessFrameQuality(frame, anchorSmall, blurThresh, sceneThresh)
+
 			# process this frame
-			processedFrame = processFrame(frame, frameCounter, refImg_kp, refImg_des, featureDetect)
+			frameSettings = featureBudget.copy()		# settings used on this frame
+			frame_startTime = time.time()
+			processedFrame = processFrame(frame, frameCounter, refImg_kp, refImg_des, featureDetect,
+								frameDecision=decision, anchorFrame=anchorFrame,
+								homographyPrior=homographyPrior, robustMethod=robustMethod,
+								matchParams=dict(matchParams, checks=featureBudget['checks']),
+								descriptorPCA=descriptorPCA)
+			frameTime = time.time() - frame_startTime
+
+			# adjust the feature budget based on how this frame went
+			if (frameBudget is not None) and (decision == 'match'):
+				if processedFrame['foundGoodMatch']:
+					numInliers = processedFrame['numMatches'] * processedFrame['inlierRatio']
+				else:
+					numInliers = None
+				if updateFeatureBudget(featureBudget, frameTime, numInliers):
+					featureDetect = createFeatureDetector(featureBudget['nfeatures'], featureBudget['contrastThreshold'])
+
+			if decision == 'match':
+				anchorSmall = small
+				anchorFrame = processedFrame
+				if processedFrame['foundGoodMatch']:
+					homographyPrior = processedFrame['ref2world']
+
+			frameLog.append({'frame': frameCounter, 'decision': decision,
+							'sharpness': sharpness, 'sceneDiff': sceneDiff,
+							'nfeatures': frameSettings['nfeatures'],
+							'contrastThreshold': frameSettings['contrastThreshold'],
+							'checks': frameSettings['checks'],
+							'frameTime': frameTime,
+							'numMatches': processedFrame['numMatches'],
+							'homographyMethod': processedFrame['homographyMethod'],
+							'inlierRatio': processedFrame['inlierRatio'],
+							'reprojError': processedFrame['reprojError'],
+							'foundGoodMatch': int(processedFrame['foundGoodMatch'])})
 
 			# if good match between reference image and this frame
 			if processedFrame['foundGoodMatch']:
@@ -277,12 +610,19 @@ def processRecording(preprocessedDir, outputDir, referenceImage_path):
 			try:
 				colOrder = ['worldFrame', 'gaze_ts', 'confidence',
 							'world_gazeX', 'world_gazeY', 'ref_gazeX', 'ref_gazeY']
-				gazeMapped_df[colOrder].to_csv(join(outputDir, 'gazeData_mapped.tsv'), sep='\t', index=False, float_format='%.3f')
+				writeTable(gazeMapped_df[colOrder], join(outputDir, 'gazeData_mapped'), tableFormat)
 			except Exception as e:
 				print(e)
-				print('cound not write gazeData_mapped to csv')
+				print('cound not write gazeData_mapped')
 				pass
 
+			# write out the per-frame log
+			frameLog_colOrder = ['frame', 'decision', 'sharpness', 'sceneDiff',
+								'nfeatures', 'contrastThreshold', 'checks', 'frameTime', 'numMatches',
+								'homographyMethod', 'inlierRatio', 'reprojError', 'foundGoodMatch']
+			frameLog_df = pd.DataFrame(frameLog, columns=frameLog_colOrder)
+			frameLog_df.to_csv(join(outputDir, 'frameLog.tsv'), sep='\t', index=False, float_format='%.3f')
+
 			# close the logFile
 			logFile.close()
 
@@ -290,16 +630,36 @@ def processRecording(preprocessedDir, outputDir, referenceImage_path):
 	frameProcessing_time = endTime - frameProcessing_startTime
 	print('Total time: %s seconds' % frameProcessing_time)
 	print('Avg time/frame: %s seconds' % (frameProcessing_time/framesToUse.shape[0]) )
+	print('Frame decisions: {}'.format(frameLog_df.decision.value_counts().to_dict()))
+	print('Homography methods: {}'.format(frameLog_df.homographyMethod.value_counts().to_dict()))
+	print('Mean matches on matched frames ({} descriptors): {:.1f}'.format(matchParams['descriptor_mode'],
+			frameLog_df.numMatches[frameLog_df.decision == 'match'].mean()))
 
 
 
-def processFrame(frame, frameNumber, ref_kp, ref_des, featureDetect):
+def processFrame(frame, frameNumber, ref_kp, ref_des, featureDetect, frameDecision='match', anchorFrame=None,
+					homographyPrior=None, robustMethod='ransac', matchParams=None, descriptorPCA=None):
 	"""
 	Process a single frame from the world camera
 		- try to find match between frame and reference image
 		- if success, return the mapping
+
+	frameDecision comes from assessFrameQuality (or processRecording's gaze check):
+		- 'skip', 'noGaze': no matching attempted
+		- 'static': reuse the result of anchorFrame (the last fully matched frame)
+		- 'match': full feature matching
+
+	homographyPrior and robustMethod are passed on to estimateHomography, matchParams to findMatches.
+	Frame descriptors are converted with compactDescriptors (descriptorPCA is needed in 'pca' mode)
 	"""
+	if matchParams is None:
+		matchParams = defaultMatchParams
+
 	fr = {}		# create dict to store info for this frame
+	fr['numMatches'] = 0
+	fr['homographyMethod'] = 'none'
+	fr['inlierRatio'] = np.nan
+	fr['reprojError'] = np.nan
 
 	# create copy of original frame
 	origFrame = frame.copy()
@@ -309,26 +669,43 @@ def processFrame(frame, frameNumber, ref_kp, ref_des, featureDetect):
 	frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
 	fr['frame_gray'] = frame_gray
 
+	# hopeless frame (motion blur, no texture) or nothing to map; don't bother matching
+	if frameDecision in ['skip', 'noGaze']:
+		fr['foundGoodMatch'] = False
+		return fr
+
+	# near-identical to the last matched frame; carry its result forward
+	if frameDecision == 'static':
+		fr['foundGoodMatch'] = anchorFrame['foundGoodMatch']
+		if anchorFrame['foundGoodMatch']:
+			fr['ref2world'] = anchorFrame['ref2world']
+			fr['world2ref'] = anchorFrame['world2ref']
+		return fr
+
 	# try to match the frame and the reference image
 	try:
 		frame_kp, frame_des = featureDetect.detectAndCompute(frame_gray, None)
+		if matchParams['descriptor_mode'] == 'pca':
+			# uint8 quantization is lossless and only saves storage, so frame descriptors are kept as float32
+			frame_des = compactDescriptors(frame_des, matchParams['descriptor_mode'], descriptorPCA)
 		print('found {} features on frame {}'.format(len(frame_kp), frameNumber))
 
 		if len(frame_kp) < 2:
 			ref_matchPts = None
 		else:
-			ref_matchPts, frame_matchPts = findMatches(ref_kp, ref_des, frame_kp, frame_des)
+			ref_matchPts, frame_matchPts = findMatches(ref_kp, ref_des, frame_kp, frame_des, matchParams=matchParams)
 
 		# check if matches were found
 		try:
 			numMatches = ref_matchPts.shape[0]
+			fr['numMatches'] = numMatches
 
 			# if sufficient number of matches....
-			if numMatches > 10:
+			if numMatches > matchParams['min_matches']:
 				print('found {} matches on frame {}'.format(numMatches, frameNumber))
 				sufficientMatches = True
 			else:
-				print('Insufficient matches ({}} matches) on frame {}'.format(numMatches, frameNumber))
+				print('Insufficient matches ({} matches) on frame {}'.format(numMatches, frameNumber))
 				sufficientMatches = False
 
 		except:
@@ -336,11 +713,19 @@ def processFrame(frame, frameNumber, ref_kp, ref_des, featureDetect):
 			sufficientMatches = False
 			pass
 
+		# figure out homographies between coordinate systems
+		if sufficientMatches:
+			ref2world_transform, homographyInfo = estimateHomography(ref_matchPts, frame_matchPts,
+										priorTransform=homographyPrior, robustMethod=robustMethod)
+			fr['homographyMethod'] = homographyInfo['method']
+			fr['inlierRatio'] = homographyInfo['inlierRatio']
+			fr['reprojError'] = homographyInfo['reprojError']
+			if ref2world_transform is None:
+				sufficientMatches = False
+
 		fr['foundGoodMatch'] = sufficientMatches
 
-		# figure out homographies between coordinate systems
 		if sufficientMatches:
-			ref2world_transform, mask = cv2.findHomography(ref_matchPts.reshape(-1,1,2), frame_matchPts.reshape(-1,1,2), cv2.RANSAC, 5.0)
 			world2ref_transform = cv2.invert(ref2world_transform)
 
 			fr['ref2world'] = ref2world_transform
@@ -358,16 +743,48 @@ if __name__ == '__main__':
 
 	# parse arguments
 	parser = argparse.ArgumentParser()
-	parser.add_argument('preprocessedDir', help='path to preprocessed data dir')
+	parser.add_argument('preprocessedDir', help='path to preprocessed data dir (or raw recording dir, with --vendor)')
 	parser.add_argument('outputDir', help='path to where you want output saved')
 	parser.add_argument('referenceImage', help='path to reference image')
+	parser.add_argument('--blurThresh', type=float, default=0,
+						help='skip matching on frames whose sharpness (variance of Laplacian) is below this value (default: 0, off; e.g. 25)')
+	parser.add_argument('--sceneThresh', type=float, default=0,
+						help='reuse the last match on frames that differ from it by less than this (mean abs gray level; default: 0, off; e.g. 1.0)')
+	parser.add_argument('--gazeOnly', action='store_true',
+						help='only match frames that contain at least one valid gaze sample')
+	parser.add_argument('--frameBudget', type=float, default=None,
+						help='target matching time per frame (ms); adapts the SIFT/FLANN settings to hold it')
+	parser.add_argument('--minInliers', type=int, default=20,
+						help='minimum homography inliers to keep when adapting to --frameBudget')
+	parser.add_argument('--matchProfile', default=None,
+						help='path to a feature matching profile written by tuneMatching.py')
+	parser.add_argument('--descriptorMode', choices=['float', 'uint8', 'pca'], default=None,
+						help='descriptor representation (overrides the matching profile; uint8 only saves storage, pca also speeds up matching)')
+	parser.add_argument('--robustMethod', choices=['ransac', 'usac'], default='ransac',
+						help='robust homography fit used when the previous frame\'s homography does not fit')
+	parser.add_argument('--tableFormat', choices=tableFormats, default=None,
+						help='storage format for the mapped gaze data (default: feather, or npz without pyarrow)')
+	parser.add_argument('--vendor', choices=vendors, default=None,
+						help='read preprocessedDir as a raw recording from this manufacturer, and preprocess it in-process')
+	parser.add_argument('--sessionNum', default=None,
+						help='session number of the recording (SMI only, with --vendor)')
 	args = parser.parse_args()
 
 	## error checking
 	if not os.path.isdir(args.preprocessedDir):
-		print('{} is not a valid preprocessed data dir').format(args.preprocessedDir)
+		print('{} is not a valid preprocessed data dir'.format(args.preprocessedDir))
 	else:
+		# read the raw recording directly, if requested
+		if args.vendor is not None:
+			print('reading the raw recording...')
+			recording = readRecording(args.vendor, args.preprocessedDir, sessionNum=args.sessionNum)
+		else:
+			recording = args.preprocessedDir
+
 		## process the recording
 		print('processing the recording...')
-		print('Output saved in: {}').format(args.outputDir)
-		processRecording(args.preprocessedDir, args.outputDir, args.referenceImage)
+		print('Output saved in: {}'.format(args.outputDir))
+		processRecording(recording, args.outputDir, args.referenceImage,
+						blurThresh=args.blurThresh, sceneThresh=args.sceneThresh, gazeOnly=args.gazeOnly,
+						robustMethod=args.robustMethod, frameBudget=args.frameBudget, minInliers=args.minInliers,
+						matchProfile=args.matchProfile, descriptorMode=args.descriptorMode, tableFormat=args.tableFormat)
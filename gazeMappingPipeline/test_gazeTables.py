@@ -0,0 +1,31 @@
+"""
+Tests for gazeTables (run with pytest)
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import gazeTables
+
+
+@pytest.mark.skipif(not gazeTables.HAS_PYARROW, reason='needs pyarrow')
+def test_featherColumnsAreMemoryMapped(tmpdir, monkeypatch):
+	n = 200000		# more rows than pyarrow's default chunk size
+	gaze_df = pd.DataFrame({'timestamp': np.arange(n) * 8.3, 'frame_idx': np.arange(n) // 4,
+							'confidence': np.ones(n), 'norm_pos_x': np.random.rand(n), 'norm_pos_y': np.random.rand(n)})
+	path = str(tmpdir.join('gazeData_world'))
+	gazeTables.writeTable(gaze_df, path, 'feather')
+
+	# keep the table read from the file, to compare against its buffers
+	tables = []
+	readFeather = gazeTables.feather.read_table
+	monkeypatch.setattr(gazeTables.feather, 'read_table', lambda *args, **kwargs: tables.append(readFeather(*args, **kwargs)) or tables[-1])
+
+	for columns in [None, ['norm_pos_y', 'frame_idx']]:
+		df = gazeTables.readTable(path, columns=columns)
+		for c in df.columns:
+			fileBuffer = np.frombuffer(tables[-1].column(c).chunk(0).buffers()[1], dtype=np.uint8)
+			assert np.shares_memory(df[c].values, fileBuffer)
+		assert np.allclose(df['norm_pos_y'], gaze_df['norm_pos_y'])
+		assert (df['frame_idx'] == gaze_df['frame_idx']).all()
@@ -0,0 +1,59 @@
+"""
+Tests for videoTools (run with pytest; needs ffmpeg and ffprobe on the path)
+"""
+
+import os
+import shutil
+import subprocess
+import numpy as np
+import pytest
+
+import videoTools
+
+pytestmark = pytest.mark.skipif(shutil.which('ffmpeg') is None or shutil.which('ffprobe') is None,
+								reason='needs ffmpeg and ffprobe')
+
+
+@pytest.fixture
+def offsetClip(tmpdir):
+	"""
+	2 s, 25 fps clip whose video stream starts 0.5 s after its audio stream, and the
+	whole file 1 s after zero (so the container and video stream starts both differ from 0)
+	"""
+	clipPath = str(tmpdir.join('clip.mkv'))
+	subprocess.check_call(['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'sine=d=2',
+							'-itsoffset', '0.5', '-f', 'lavfi', '-i', 'testsrc=size=64x48:rate=25:d=2',
+							'-map', '1:v', '-map', '0:a', '-c:v', 'libx264', '-c:a', 'aac',
+							'-output_ts_offset', '1', clipPath])
+	return clipPath
+
+
+def test_transcodeTimestampsMatchProbe(offsetClip, tmpdir):
+	expected = videoTools.probeFrameTimestamps(offsetClip)
+	assert expected[0] == 0
+	assert np.allclose(np.diff(expected), 40)
+
+	outputPath = str(tmpdir.join('worldCamera.mp4'))
+	frame_timestamps = videoTools.transcodeVideo(offsetClip, outputPath, frameTimestamps=True)
+	assert np.array_equal(frame_timestamps, expected)
+
+
+def test_skipExistingKeepsTimestamps(offsetClip, tmpdir):
+	outputPath = str(tmpdir.join('worldCamera.mp4'))
+	transcoded = videoTools.transcodeVideo(offsetClip, outputPath, frameTimestamps=True)
+	modified = os.path.getmtime(outputPath)
+
+	# the existing output is kept, and the same timestamps are returned
+	reused = videoTools.transcodeVideo(offsetClip, outputPath, frameTimestamps=True)
+	assert os.path.getmtime(outputPath) == modified
+	assert np.array_equal(reused, transcoded)
+
+
+def test_failedTranscodeRemovesOutput(offsetClip, tmpdir):
+	outputPath = str(tmpdir.join('worldCamera.mp4'))
+	with open(outputPath, 'wb') as f:		# stale, incomplete output from an earlier run
+		f.write(b'\0' * 1024)
+
+	with pytest.raises(subprocess.CalledProcessError):
+		videoTools.transcodeVideo(offsetClip, outputPath, encodeOptions={'preset': 'notAPreset'})
+	assert not os.path.exists(outputPath)
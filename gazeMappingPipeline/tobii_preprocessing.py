@@ -5,11 +5,13 @@ Tested with Python 3.6, open CV 3.2
 
 Since the data originates on a SD card (or temp directory somewhere), a new output directory
 will be created for each recording. The output directory will be created within the output root path specified by the user, and named according to [mo-day-yr]/[hr-min-sec] of the original creation time.
+The raw data is read in place; only the final outputs are written to the output directory.
 
 The output directory will contain:
-	- frame_timestamps.tsv: frame number and corresponding timestamps for each frame in video
+	- frame_timestamps.<fmt>: frame number and corresponding timestamps for each frame in video
 	- worldCamera.mp4: the video from the point-of-view scene camera on the glasses
-	- gazeData_world.tsv: gaze data, where all gaze coordinates are represented w/r/t the world camera
+	- gazeData_world.<fmt>: gaze data, where all gaze coordinates are represented w/r/t the world camera
+(tables are written as feather by default; see gazeTables.py for the other formats)
 """
 
 # python 2/3 compatibility
@@ -22,48 +24,50 @@ from datetime import datetime
 from os.path import join
 import json
 import gzip
-import cv2
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
 
+from gazeTables import writeTable, writeGazeData, writeFrameTimestamps, tableFormats
+from videoTools import getVidFrameTimestamps, transcodeVideo, defaultEncodeOptions, x264Presets
+from gazeAlignment import alignToFrames
 
-def preprocessData(inputDir, output_root):
+
+def preprocessData(inputDir, output_root, tableFormat=None, encodeOptions=None, frameRate=None):
 	"""
 	Run all preprocessing steps on tobii data
+
+	encodeOptions: x264 settings for the world camera video (see videoTools.transcodeVideo)
+	frameRate: if given, read the world camera video at this frame rate (e.g. 25) instead of its own timestamps
+
+	Returns the path to the output dir
 	"""
-	### copy the raw data to the output directory
-	print('Copying raw data...')
-	newDataDir = copyTobiiRecording(inputDir, output_root)
-	print('Input data copied to: {}'.format(newDataDir))
+	### create the output directory (the raw data is read from the input dir directly)
+	newDataDir = makeOutputDir(inputDir, output_root)
+	print('Output will be saved to: {}'.format(newDataDir))
 
-	#### prep the copied data...
-	print('Prepping gaze data...')
-	gazeWorld_df, frame_timestamps = formatGazeData(newDataDir)
+	### compress movie in the background, while the gaze data is prepped
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		transcode = executor.submit(transcodeVideo, join(inputDir, 'fullstream.mp4'), join(newDataDir, 'worldCamera.mp4'),
+									encodeOptions=encodeOptions, inputFrameRate=frameRate)
 
-	# write the gaze data (world camera coords) to a csv file
-	gazeWorld_df.to_csv(join(newDataDir, 'gazeData_world.tsv'), sep='\t', index=False)
+		#### prep the gaze data...
+		print('Prepping gaze data...')
+		gazeWorld_df, frame_timestamps = formatGazeData(inputDir, newDataDir, tableFormat)
 
-	### convert the frame_timestamps to dataframe
-	frameNum = np.arange(1, frame_timestamps.shape[0]+1)
-	frame_ts_df = pd.DataFrame({'frameNum':frameNum, 'timestamp':frame_timestamps})
-	frame_ts_df.to_csv(join(newDataDir, 'frame_timestamps.tsv'), sep='\t', index=False)
+		# write the gaze data (world camera coords) and frame timestamps
+		writeGazeData(newDataDir, gazeWorld_df, tableFormat)
+		writeFrameTimestamps(newDataDir, frame_timestamps, tableFormat)
 
-	### compress movie
-	print('Compressing movie file...')
-	cmd_str = ' '.join(['ffmpeg', '-r 25', '-i', join(newDataDir, 'fullstream.mp4'), '-pix_fmt', 'yuv420p', join(newDataDir, 'worldCamera.mp4')])
-	os.system(cmd_str)
+		# wait for the movie (raises any transcoding error)
+		transcode.result()
 
-	### cleanup
-	for f in ['fullstream.mp4', 'livedata.json']:
-		try:
-			os.remove(join(newDataDir, f))
-		except:
-			pass
+	return newDataDir
 
 
-def copyTobiiRecording(input_dir, output_root):
+def makeOutputDir(input_dir, output_root):
 	"""
-	Copy the relevant files from the specified input dir to the specified output dir
+	Create the output dir for the recording in input_dir, named by its creation date and time
 	"""
 
 	# read the data and creation time from the segment.json file
@@ -79,25 +83,13 @@ def copyTobiiRecording(input_dir, output_root):
 		os.makedirs(join(output_root, date_dir, time_dir))
 	outputDir = join(output_root, date_dir, time_dir)
 
-	# Copy relevent files to new directory
-	for f in ['livedata.json.gz', 'fullstream.mp4']:
-		shutil.copyfile(join(input_dir, f), join(outputDir, f))
-
-	# Unzip the gaze data file
-	with gzip.open(join(outputDir, 'livedata.json.gz')) as zipFile:
-		with open(join(outputDir, 'livedata.json'), 'wb') as unzippedFile:
-			for line in zipFile:
-
-				unzippedFile.write(line)
-	os.remove(join(outputDir, 'livedata.json.gz'))
-
 	# return the full path to the output dir
 	return outputDir
 
 
-def formatGazeData(input_dir):
+def formatGazeData(input_dir, output_dir=None, tableFormat=None):
 	"""
-	load livedata.json, write to csv
+	load livedata.json.gz from input_dir, write to gazeData_raw in output_dir (skipped if output_dir is None)
 	format to get the gaze coordinates w/r/t world camera, and timestamps for every frame of video
 
 	Returns:
@@ -106,8 +98,9 @@ def formatGazeData(input_dir):
 	"""
 
 	# convert the json file to pandas dataframe
-	raw_df = json_to_df(join(input_dir, 'livedata.json'))
-	raw_df.to_csv(join(input_dir, 'gazeData_raw.tsv'), sep='\t')
+	raw_df = json_to_df(join(input_dir, 'livedata.json.gz'))
+	if output_dir is not None:
+		writeTable(raw_df.reset_index(), join(output_dir, 'gazeData_raw'), tableFormat)
 
 	# drop any row that precedes the start of the video timestamps
 	raw_df = raw_df[raw_df.vts_time >= raw_df.vts_time.min()]
@@ -122,15 +115,8 @@ def formatGazeData(input_dir):
 	frame_timestamps = getVidFrameTimestamps(join(input_dir, 'fullstream.mp4'))
 
 	# use the frame timestamps to assign a frame number to each data point
-	frame_idx = np.zeros(data_ts.shape[0])
-	for i,thisVTS in enumerate(vts):
-
-		# get the frame_timestamp index of where thisVTS would be inserted
-		idx = np.searchsorted(frame_timestamps, thisVTS)
-		if idx == 0: idx = 1
-
-		# set the frame number based on this index value
-		frame_idx[i] = idx-1
+	# (the latest frame that started before each vts; samples before the first frame get frame 0)
+	frame_idx = alignToFrames(vts, frame_timestamps, policy='next', unmatched='clip')
 
 	# build the formatted dataframe
 	gaze_df = pd.DataFrame({'timestamp':data_ts, 'confidence':confidence, 'frame_idx': frame_idx, 'norm_pos_x':norm_gazeX, 'norm_pos_y':norm_gazeY})
@@ -140,128 +126,100 @@ def formatGazeData(input_dir):
 	return gaze_df[colOrder], frame_timestamps
 
 
-def getVidFrameTimestamps(vid_file):
-	"""
-	Load the supplied video, return an array of frame timestamps
-	"""
-	OPENCV3 = (cv2.__version__.split('.')[0] == '3')		# get opencv version
-
-	vid = cv2.VideoCapture(vid_file)
-
-	# figure out the total number of frames in this video file
-	if OPENCV3:
-		totalFrames = vid.get(cv2.CAP_PROP_FRAME_COUNT)
-	else:
-		totalFrames = vid.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT)
-
-	frame_ts = np.zeros(int(totalFrames))
-
-	# loop through all video frames
-	frameCounter = 0
-	while vid.isOpened():
-		# read the next frame
-		ret, frame = vid.read()
-
-		# check if its valid:
-		if ret == True:
-			if OPENCV3:
-				thisFrameTS = vid.get(cv2.CAP_PROP_POS_MSEC)
-			else:
-				thisFrameTS = vid.get(cv2.cv.CV_CAP_PROP_POS_MSEC)
-
-			# write this frame's ts to the array
-			frame_ts[frameCounter] = thisFrameTS
-
-			# increment frame counter
-			frameCounter += 1
-
-		else:
-			break
-	vid.release()		# close the video
-
-	return frame_ts
+### livedata.json record types, and the columns they fill
+# eye records ("eye" key) get the eye ('l' or 'r') as a column prefix
+eyeRecordCols = {'pc': ['_pup_cent_x', '_pup_cent_y', '_pup_cent_z', '_pup_cent_val'],
+				'pd': ['_pup_diam', '_pup_diam_val'],
+				'gd': ['_gaze_dir_x', '_gaze_dir_y', '_gaze_dir_z', '_gaze_dir_val']}
+gazeRecordCols = {'gp': ['gaze_pos_x', 'gaze_pos_y', 'gaze_pos_val'],
+				'gp3': ['3d_gaze_pos_x', '3d_gaze_pos_y', '3d_gaze_pos_z', '3d_gaze_pos_val']}
 
 
 def json_to_df(json_file):
 	"""
-	convert the livedata.json file to a pandas dataframe
+	convert the livedata.json.gz file to a pandas dataframe, indexed by data timestamp (ts; microseconds)
+
+	The file is streamed line by line, and the values of each record type are collected
+	in separate lists; the table is then assembled in one step, aligned on ts.
+	Confidence (1 if the status of the record is 0) is taken from the last record at each ts
 	"""
 	# dicts to store sync points
 	vts_sync = {}			# RECORDED video timestamp sync
-	df = pd.DataFrame()     # empty dataframe to write data to
+	records = {}			# (column prefix, record key): ([ts], [values])
+	conf_ts = []
+	conf = []
 
-	with open(json_file, 'rb') as j:
+	with gzip.open(json_file, 'rb') as j:
 
 		# loop over all lines in json file, each line represents unique json object
 		for line in j:
 			entry = json.loads(line)
 
 			### a number of different dictKeys are possible, respond accordingly
-			if 'vts' in entry.keys(): # "vts" key signfies a video timestamp (first frame, first keyframe, and ~1/min afterwards)
+			if 'vts' in entry: # "vts" key signfies a video timestamp (first frame, first keyframe, and ~1/min afterwards)
 				vts_sync[entry['ts']] = entry['vts']
 				continue
 
-			# if this json object contains "eye" data (e.g. pupil info)
-			if 'eye' in entry.keys():
-				which_eye = entry['eye'][:1]
-				if 'pc' in entry.keys():
-					df.loc[entry['ts'], which_eye + '_pup_cent_x'] = entry['pc'][0]
-					df.loc[entry['ts'], which_eye + '_pup_cent_y'] = entry['pc'][1]
-					df.loc[entry['ts'], which_eye + '_pup_cent_z'] = entry['pc'][2]
-					df.loc[entry['ts'], which_eye + '_pup_cent_val'] = entry['s']
-					df.loc[entry['ts'], 'confidence'] = int(entry['s'] == 0)
-				elif 'pd' in entry.keys():
-					df.loc[entry['ts'], which_eye + '_pup_diam'] = entry['pd']
-					df.loc[entry['ts'], which_eye + '_pup_diam_val'] = entry['s']
-					df.loc[entry['ts'], 'confidence'] = int(entry['s'] == 0)
-				elif 'gd' in entry.keys():
-					df.loc[entry['ts'], which_eye + '_gaze_dir_x'] = entry['gd'][0]
-					df.loc[entry['ts'], which_eye + '_gaze_dir_y'] = entry['gd'][1]
-					df.loc[entry['ts'], which_eye + '_gaze_dir_z'] = entry['gd'][2]
-					df.loc[entry['ts'], which_eye + '_gaze_dir_val'] = entry['s']
-					df.loc[entry['ts'], 'confidence'] = int(entry['s'] == 0)
-
-			# otherwise it contains gaze position data
+			# if this json object contains "eye" data (e.g. pupil info), otherwise it contains gaze position data
+			if 'eye' in entry:
+				prefix = entry['eye'][:1]
+				recordCols = eyeRecordCols
 			else:
-				if 'gp' in entry.keys():
-					df.loc[entry['ts'], 'gaze_pos_x'] = entry['gp'][0]
-					df.loc[entry['ts'], 'gaze_pos_y'] = entry['gp'][1]
-					df.loc[entry['ts'], 'gaze_pos_val'] = entry['s']
-					df.loc[entry['ts'], 'confidence'] = int(entry['s'] == 0)
-				elif 'gp3' in entry.keys():
-					df.loc[entry['ts'], '3d_gaze_pos_x'] = entry['gp3'][0]
-					df.loc[entry['ts'], '3d_gaze_pos_y'] = entry['gp3'][1]
-					df.loc[entry['ts'], '3d_gaze_pos_z'] = entry['gp3'][2]
-					df.loc[entry['ts'], '3d_gaze_pos_val'] = entry['s']
-					df.loc[entry['ts'], 'confidence'] = int(entry['s'] == 0)
-
-
-		# set video timestamps column
-		df['vts_time'] = np.array(df.index)	   # df.index is data timstamps
-		df.ix[df.index < min(sorted(vts_sync.keys())), 'vts_time'] = np.nan		# set rows that occur before the first frame to nan
-
-		# for each new vts sync package, reindex all of the rows above that timestamp
-		for key in sorted(vts_sync.keys()):
-			df.ix[df.index >= key, 'vts_time'] = np.array(df.index)[df.index >= key]   # necessary if there are more than 2 keys in the list (prior key changes need to be reset for higher vts syncs)
-			df.ix[df.index >= key, 'vts_time'] = df.vts_time - key + vts_sync[key]
-
-		# note: the vts column indicates, in microseconds, where this datapoint would occur in the video timeline
-		# these do NOT correspond to the timestamps of when the videoframes were acquired. Need cv2 methods for that.
-
-		# add seconds column
-		df = df.reset_index()
-		df['seconds'] = (df['index'] - df['index'][0]) / 1000000.0		# convert tobii ts (us) to seconds
-		df = df.set_index('index', drop=True)
-
-		# return the dataframe
-		return df
+				prefix = ''
+				recordCols = gazeRecordCols
+
+			for key in recordCols:
+				if key in entry:
+					values = entry[key] if isinstance(entry[key], list) else [entry[key]]
+					thisRecord = records.setdefault((prefix, key), ([], []))
+					thisRecord[0].append(entry['ts'])
+					thisRecord[1].append(values + [entry['s']])
+					conf_ts.append(entry['ts'])
+					conf.append(int(entry['s'] == 0))
+					break
+
+	# build the columns for each record type (keeping the last record at each ts)
+	columns = []
+	for (prefix, key), (ts, values) in records.items():
+		recordCols = eyeRecordCols if prefix else gazeRecordCols
+		thisRecord_df = pd.DataFrame(np.array(values, dtype=float), index=np.array(ts, dtype=np.int64),
+										columns=[prefix + c for c in recordCols[key]])
+		columns.append(thisRecord_df[~thisRecord_df.index.duplicated(keep='last')])
+	confidence = pd.Series(conf, index=np.array(conf_ts, dtype=np.int64), name='confidence', dtype=float)
+	columns.append(confidence[~confidence.index.duplicated(keep='last')])
+
+	# align all columns on ts
+	df = pd.concat(columns, axis=1).sort_index()
+
+	# set video timestamps column: each row is synced using the latest vts sync package at or before it
+	# (rows that occur before the first sync package are nan)
+	syncKeys = np.array(sorted(vts_sync.keys()), dtype=np.int64)
+	syncVTS = np.array([vts_sync[k] for k in syncKeys], dtype=float)
+	syncIdx = np.searchsorted(syncKeys, df.index.values, side='right') - 1
+	vts_time = df.index.values - syncKeys[np.maximum(syncIdx, 0)] + syncVTS[np.maximum(syncIdx, 0)]
+	df['vts_time'] = np.where(syncIdx >= 0, vts_time, np.nan)
+
+	# note: the vts column indicates, in microseconds, where this datapoint would occur in the video timeline
+	# these do NOT correspond to the timestamps of when the videoframes were acquired. Need cv2 methods for that.
+
+	# add seconds column
+	df.index.name = 'index'
+	df['seconds'] = (df.index - df.index[0]) / 1000000.0		# convert tobii ts (us) to seconds
+
+	# return the dataframe
+	return df
 
 
 if __name__ == '__main__':
 	# parse arguments
 	parser = argparse.ArgumentParser()
 	parser.add_argument('inputDir', help='path to the raw recording dir (e.g. SD card)')
-	parser.add_argument('outputRoot', help='path to where output data copied and saved to')
+	parser.add_argument('outputRoot', help='path to where output data is saved to')
+	parser.add_argument('--tableFormat', choices=tableFormats, default=None, help='format for the output gaze tables')
+	parser.add_argument('--preset', choices=x264Presets, default=defaultEncodeOptions['preset'], help='x264 preset for the world camera video')
+	parser.add_argument('--crf', type=int, default=defaultEncodeOptions['crf'], help='x264 constant rate factor (quality; lower is better)')
+	parser.add_argument('--threads', type=int, default=None, help='number of ffmpeg threads (default: chosen by ffmpeg)')
+	parser.add_argument('--frameRate', type=float, default=None, help='read the world camera video at this frame rate (e.g. 25) instead of its own timestamps')
 	args = parser.parse_args()
 
 	# Check if input directory is valid
@@ -271,4 +229,5 @@ if __name__ == '__main__':
 	else:
 
 		# run preprocessing on this data
-		preprocessData(args.inputDir, args.outputRoot)
+		preprocessData(args.inputDir, args.outputRoot, tableFormat=args.tableFormat,
+						encodeOptions={'preset': args.preset, 'crf': args.crf, 'threads': args.threads}, frameRate=args.frameRate)
@@ -0,0 +1,235 @@
+"""
+Tune the feature matching settings used by processData.py for a given recording
+
+Different glasses models have very different world camera optics, so a single set of
+FLANN/ratio-test settings does not fit all of them. This script samples frames from a
+preprocessed recording and evaluates a grid of matching settings on them:
+	- trees, checks:		FLANN kd-tree settings
+	- distance_ratio:		ratio test threshold
+	- min_good_matches:		matches needed for findMatches to return any points
+	- min_matches:			matches needed to attempt a homography on a frame
+	- descriptor_mode:		descriptor representation (float, uint8, or PCA-projected)
+
+Each setting is scored on runtime, mean number of good matches, and on how often its homography agrees with the
+homography found using exhaustive (brute-force) matching on the same frame. The fastest
+setting whose agreement is within tolerance of the best is written as a matching profile,
+which can be passed to processData.py with --matchProfile
+
+Output:
+	- <profile>.json:	recommended matching profile
+	- <profile>.tsv:	scores for every setting in the grid
+"""
+
+# python 2/3 compatibility
+from __future__ import division
+from __future__ import print_function
+
+import os, sys
+import time
+import argparse
+import itertools
+import json
+import numpy as np
+import pandas as pd
+from os.path import join
+import cv2
+
+from processData import createFeatureDetector, defaultMatchParams, fitDescriptorPCA, compactDescriptors, OPENCV3
+
+### Configuration vars
+paramGrid = {'trees': [1, 5, 8],
+			'checks': [5, 10, 32, 64],
+			'distance_ratio': [0.5, 0.6, 0.7, 0.8],
+			'min_good_matches': [4, 8],
+			'min_matches': [10, 15, 25],
+			'descriptor_mode': ['float', 'uint8', 'pca']}
+pcaComponents = 32			# dimensions kept in 'pca' descriptor mode
+baselineRatio = 0.7			# ratio test threshold used with the brute-force baseline
+baselineMinMatches = 10		# matches needed for the baseline to attempt a homography
+agreementTol = 5			# max mean displacement (px) of the reference corners for 2 homographies to agree
+agreementSlack = 0.01		# recommended setting may be this far below the best agreement rate
+
+
+def sampleFrames(vidPath, nFrames):
+	"""
+	Read nFrames evenly spaced frames from the video, returned as grayscale images
+	"""
+	vid = cv2.VideoCapture(vidPath)
+	if OPENCV3:
+		totalFrames = int(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+	else:
+		totalFrames = int(vid.get(cv2.cv.CV_CAP_PROP_FRAME_COUNT))
+	frameIndices = set(np.unique(np.linspace(0, totalFrames-1, nFrames).astype(int)))
+
+	frames = {}
+	frameCounter = 0
+	while vid.isOpened() and (len(frames) < len(frameIndices)):
+		# grab every frame, but only convert the sampled ones
+		if not vid.grab():
+			break
+		if frameCounter in frameIndices:
+			ret, frame = vid.retrieve()
+			if ret:
+				frames[frameCounter] = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+		frameCounter += 1
+	vid.release()
+
+	return frames
+
+
+def ratioTest(matches, distance_ratio):
+	"""
+	Return the (queryIdx, trainIdx) pairs from knn matches (k=2) that pass the ratio test
+	"""
+	pairs = [(m.queryIdx, m.trainIdx) for m, n in (mn for mn in matches if len(mn) == 2)
+				if m.distance < distance_ratio*n.distance]
+	return np.array(pairs, dtype=int).reshape(-1, 2)
+
+
+def fitHomography(pairs, ref_pts, frame_pts, min_good_matches, min_matches):
+	"""
+	Fit the ref -> frame homography the same way processData.py does, or return None
+	"""
+	if (pairs.shape[0] <= min_good_matches) or (pairs.shape[0] <= min_matches):
+		return None
+	transform2D, mask = cv2.findHomography(ref_pts[pairs[:,0]].reshape(-1,1,2),
+											frame_pts[pairs[:,1]].reshape(-1,1,2), cv2.RANSAC, 5.0)
+	return transform2D
+
+
+def homographiesAgree(H1, H2, corners):
+	"""
+	Two homographies agree if both are missing, or if they place the reference image corners
+	within agreementTol pixels of each other (on average)
+	"""
+	if (H1 is None) or (H2 is None):
+		return (H1 is None) and (H2 is None)
+	c1 = cv2.perspectiveTransform(corners, H1)
+	c2 = cv2.perspectiveTransform(corners, H2)
+	return np.mean(np.linalg.norm(c1 - c2, axis=2)) < agreementTol
+
+
+def tuneMatching(preprocessedDir, referenceImage_path, profilePath, nFrames=300):
+	"""
+	Evaluate the matching settings grid on nFrames frames of the recording in
+	preprocessedDir, and write the recommended matching profile to profilePath
+	"""
+	featureDetect = createFeatureDetector()
+
+	### reference image features
+	refImg = cv2.imread(referenceImage_path)
+	refImg = cv2.cvtColor(refImg, cv2.COLOR_BGR2GRAY)
+	ref_kp, ref_des = featureDetect.detectAndCompute(refImg, None)
+	ref_pts = np.float32([kp.pt for kp in ref_kp])
+	h, w = refImg.shape
+	corners = np.float32([[0, 0], [w, 0], [w, h], [0, h]]).reshape(-1,1,2)
+	print('Reference Image: found {} keypoints'.format(len(ref_kp)))
+
+	### frame features
+	print('sampling {} frames...'.format(nFrames))
+	frames = sampleFrames(join(preprocessedDir, 'worldCamera.mp4'), nFrames)
+	frameFeatures = []
+	for frameNum in sorted(frames):
+		frame_kp, frame_des = featureDetect.detectAndCompute(frames[frameNum], None)
+		if (frame_des is None) or (len(frame_kp) < 2):
+			continue
+		frameFeatures.append((np.float32([kp.pt for kp in frame_kp]), frame_des))
+	print('{} sampled frames have features'.format(len(frameFeatures)))
+
+	### brute-force baseline
+	bruteForce = cv2.BFMatcher(cv2.NORM_L2)
+	baseline = []
+	for frame_pts, frame_des in frameFeatures:
+		pairs = ratioTest(bruteForce.knnMatch(ref_des, frame_des, k=2), baselineRatio)
+		baseline.append(fitHomography(pairs, ref_pts, frame_pts, 4, baselineMinMatches))
+	print('baseline found the reference on {} of {} frames'.format(
+			sum(H is not None for H in baseline), len(baseline)))
+
+	### evaluate the grid
+	# the FLANN search only depends on the descriptors and trees/checks, so run it once per
+	# combination and apply the ratio test and match count thresholds to its output
+	results = []
+	for descriptor_mode in paramGrid['descriptor_mode']:
+		pca = fitDescriptorPCA(ref_des, pcaComponents) if descriptor_mode == 'pca' else None
+		mode_ref_des = compactDescriptors(ref_des, descriptor_mode, pca)
+		mode_frame_des = [compactDescriptors(frame_des, descriptor_mode, pca) for frame_pts, frame_des in frameFeatures]
+
+		for trees, checks in itertools.product(paramGrid['trees'], paramGrid['checks']):
+			matcher = cv2.FlannBasedMatcher(dict(algorithm=0, trees=trees), dict(checks=checks))
+
+			searchTime = 0
+			allMatches = []
+			for frame_des in mode_frame_des:
+				startTime = time.time()
+				allMatches.append(matcher.knnMatch(np.asarray(mode_ref_des, dtype=np.float32),
+													np.asarray(frame_des, dtype=np.float32), k=2))
+				searchTime += time.time() - startTime
+
+			for distance_ratio in paramGrid['distance_ratio']:
+				fitTime = 0
+				allPairs = []
+				for matches in allMatches:
+					startTime = time.time()
+					allPairs.append(ratioTest(matches, distance_ratio))
+					fitTime += time.time() - startTime
+				meanMatches = np.mean([pairs.shape[0] for pairs in allPairs])
+
+				for min_good_matches, min_matches in itertools.product(paramGrid['min_good_matches'], paramGrid['min_matches']):
+					nAgree = 0
+					thisFitTime = fitTime
+					for pairs, (frame_pts, frame_des), H_baseline in zip(allPairs, frameFeatures, baseline):
+						startTime = time.time()
+						H = fitHomography(pairs, ref_pts, frame_pts, min_good_matches, min_matches)
+						thisFitTime += time.time() - startTime
+						nAgree += homographiesAgree(H, H_baseline, corners)
+
+					results.append({'descriptor_mode': descriptor_mode, 'pca_components': pcaComponents,
+									'trees': trees, 'checks': checks, 'distance_ratio': distance_ratio,
+									'min_good_matches': min_good_matches, 'min_matches': min_matches,
+									'meanMatches': meanMatches,
+									'agreement': nAgree/len(frameFeatures),
+									'msPerFrame': (searchTime + thisFitTime)/len(frameFeatures) * 1000})
+			print('evaluated {} descriptors, trees={}, checks={}'.format(descriptor_mode, trees, checks))
+
+	results_df = pd.DataFrame(results)
+
+	### pick the fastest setting with near-best agreement
+	candidates = results_df[results_df.agreement >= (results_df.agreement.max() - agreementSlack)]
+	best = candidates.sort_values('msPerFrame').iloc[0]
+	matchParams = {k: type(v)(best[k]) for k, v in defaultMatchParams.items()}
+
+	isDefault = ((results_df[list(defaultMatchParams.keys())] == pd.Series(defaultMatchParams)).all(axis=1))
+	default = results_df[isDefault].iloc[0] if isDefault.any() else None
+
+	profile = {'matchParams': matchParams,
+				'agreement': best.agreement,
+				'meanMatches': best.meanMatches,
+				'msPerFrame': best.msPerFrame,
+				'nFrames': len(frameFeatures),
+				'recording': os.path.abspath(preprocessedDir),
+				'referenceImage': os.path.abspath(referenceImage_path)}
+	with open(profilePath, 'w') as f:
+		json.dump(profile, f, indent=4)
+	results_df.to_csv(os.path.splitext(profilePath)[0] + '.tsv', sep='\t', index=False, float_format='%.3f')
+
+	print('Recommended settings: {}'.format(matchParams))
+	print('agreement: {:.3f}, {:.1f} matches, {:.2f} ms/frame'.format(best.agreement, best.meanMatches, best.msPerFrame))
+	if default is not None:
+		print('defaults:  agreement: {:.3f}, {:.1f} matches, {:.2f} ms/frame'.format(default.agreement, default.meanMatches, default.msPerFrame))
+
+
+if __name__ == '__main__':
+
+	# parse arguments
+	parser = argparse.ArgumentParser()
+	parser.add_argument('preprocessedDir', help='path to preprocessed data dir')
+	parser.add_argument('referenceImage', help='path to reference image')
+	parser.add_argument('profile', help='path to write the matching profile to (e.g. tobii_matching.json)')
+	parser.add_argument('--nFrames', type=int, default=300, help='number of frames to sample')
+	args = parser.parse_args()
+
+	## error checking
+	if not os.path.isdir(args.preprocessedDir):
+		print('{} is not a valid preprocessed data dir'.format(args.preprocessedDir))
+	else:
+		tuneMatching(args.preprocessedDir, args.referenceImage, args.profile, nFrames=args.nFrames)
@@ -0,0 +1,237 @@
+"""
+Video utilities shared by the preprocessing scripts
+"""
+
+# python 2/3 compatibility
+from __future__ import division
+from __future__ import print_function
+
+import os
+import re
+import json
+import subprocess
+from contextlib import contextmanager
+import numpy as np
+import cv2
+
+OPENCV2 = (cv2.__version__.split('.')[0] == '2')
+
+# x264 settings for transcodeVideo (ffmpeg's defaults; threads=None lets ffmpeg choose)
+defaultEncodeOptions = {'preset': 'medium',
+						'crf': 23,
+						'threads': None}
+x264Presets = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow']
+
+# semaphore capping the number of concurrent ffmpeg encodes across worker processes (see setEncodeLimit)
+encodeSemaphore = None
+
+
+def setEncodeLimit(semaphore):
+	"""
+	Share a multiprocessing semaphore that every ffmpeg encode must hold while it runs.
+	Used as a process pool initializer (see batchPreprocessing.py)
+	"""
+	global encodeSemaphore
+	encodeSemaphore = semaphore
+
+
+@contextmanager
+def encodeSlot():
+	"""
+	Wait for a free encode slot, if an encode limit was set; hold it until the block exits
+	"""
+	if encodeSemaphore is None:
+		yield
+	else:
+		with encodeSemaphore:
+			yield
+
+
+def getVidFrameTimestamps(vid_file):
+	"""
+	Return an array of frame timestamps (ms, relative to the start of the video stream)
+	for the supplied video, without decoding the frames.
+
+	The presentation timestamps are read from the container with ffprobe. If ffprobe
+	isn't available (or can't read the timestamps), the frames are stepped through with
+	OpenCV's grab(), which skips converting them to images.
+	"""
+	try:
+		return probeFrameTimestamps(vid_file)
+	except (OSError, ValueError, subprocess.CalledProcessError) as e:
+		print('Could not read frame timestamps with ffprobe ({}); stepping through frames instead'.format(e))
+		return grabFrameTimestamps(vid_file)
+
+
+def probeFrameTimestamps(vid_file):
+	"""
+	Read the presentation timestamp of every packet in the first video stream with ffprobe
+	"""
+	cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+			'-show_entries', 'stream=start_pts,time_base:packet=pts', '-of', 'json', vid_file]
+	probe = json.loads(subprocess.check_output(cmd).decode('utf-8'))
+
+	pts = [p.get('pts') for p in probe.get('packets', [])]
+	if len(pts) == 0 or any(t is None for t in pts):
+		raise ValueError('missing packet timestamps')
+	stream = probe['streams'][0]
+
+	return ptsToTimestamps(pts, stream.get('start_pts', min(pts)), parseTimeBase(stream['time_base']))
+
+
+def probeStreamStart(vid_file):
+	"""
+	Return the start pts and time base (num, den) of the first video stream, read with ffprobe.
+	start pts is None if the stream doesn't have one
+	"""
+	cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+			'-show_entries', 'stream=start_pts,time_base', '-of', 'json', vid_file]
+	stream = json.loads(subprocess.check_output(cmd).decode('utf-8'))['streams'][0]
+	return stream.get('start_pts'), parseTimeBase(stream['time_base'])
+
+
+def parseTimeBase(timeBase):
+	"""
+	Parse a time base string (e.g. '1/12800') into (num, den)
+	"""
+	num, den = timeBase.split('/')
+	return int(num), int(den)
+
+
+def ptsToTimestamps(pts, startPts, timeBase):
+	"""
+	Convert presentation timestamps (in time base units) to frame timestamps in ms, relative to
+	startPts (the start of the video stream). Frames are presented in timestamp order, so the
+	timestamps are sorted (packets are stored in decoding order)
+	"""
+	return (np.sort(np.array(pts, dtype=np.int64)) - startPts) * timeBase[0] / timeBase[1] * 1000
+
+
+def grabFrameTimestamps(vid_file):
+	"""
+	Step through every frame of the video with grab() (no retrieve), recording its timestamp
+	"""
+	vid = cv2.VideoCapture(vid_file)
+	if OPENCV2:
+		posProp = cv2.cv.CV_CAP_PROP_POS_MSEC
+	else:
+		posProp = cv2.CAP_PROP_POS_MSEC
+
+	frame_ts = []
+	while vid.isOpened():
+		if not vid.grab():
+			break
+		frame_ts.append(vid.get(posProp))
+	vid.release()		# close the video
+
+	return np.array(frame_ts)
+
+
+def countFrames(vid_file):
+	"""
+	Count the frames in the first video stream. Packets are counted with ffprobe (no decoding);
+	if ffprobe isn't available, the frames are stepped through with grab() instead
+	"""
+	cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+			'-show_entries', 'stream=nb_read_packets', '-of', 'csv=p=0', vid_file]
+	try:
+		return int(subprocess.check_output(cmd).decode('utf-8').strip().split(',')[0])
+	except (OSError, ValueError, subprocess.CalledProcessError):
+		return grabFrameTimestamps(vid_file).shape[0]
+
+
+def transcodeVideo(inputPath, outputPath, frameTimestamps=False, encodeOptions=None, inputFrameRate=None,
+					skipExisting=True):
+	"""
+	Transcode the video at inputPath to an h264/yuv420p mp4 at outputPath with ffmpeg,
+	passing every frame through unchanged (no frames dropped or duplicated).
+
+	encodeOptions: dict overriding defaultEncodeOptions (x264 preset, crf, and number of ffmpeg threads)
+	inputFrameRate: if given, the input is read at this frame rate instead of its own timestamps
+	skipExisting: if outputPath already exists with the same number of frames as the input, it is kept
+			(the frame timestamps returned are the same either way)
+
+	The number of frames in the output is checked against the input; if they differ, the output is
+	removed and a ValueError is raised. Progress is printed every 10% of the frames.
+
+	If frameTimestamps is True, also return the timestamp (ms, relative to the start of
+	the video stream) of every input frame, read from the same ffmpeg pass. The input timestamps
+	are passed through unshifted (-copyts), and converted exactly as in probeFrameTimestamps, so
+	the result matches getVidFrameTimestamps on the input
+	"""
+	options = dict(defaultEncodeOptions, **(encodeOptions or {}))
+	nFrames = countFrames(inputPath)
+	vidName = os.path.basename(outputPath)
+
+	# keep an existing, complete output
+	if skipExisting and os.path.exists(outputPath) and countFrames(outputPath) == nFrames:
+		if not frameTimestamps:
+			print('{} already exists with all {} frames; skipping transcode'.format(vidName, nFrames))
+			return
+
+		# the timestamps must match those read while transcoding, so they are only
+		# taken from ffprobe; without it, the video is transcoded again to read them
+		try:
+			frame_timestamps = probeFrameTimestamps(inputPath)
+			print('{} already exists with all {} frames; skipping transcode'.format(vidName, nFrames))
+			return frame_timestamps
+		except (OSError, ValueError, KeyError, subprocess.CalledProcessError) as e:
+			print('Could not read frame timestamps with ffprobe ({}); transcoding {} again'.format(e, vidName))
+
+	cmd = ['ffmpeg', '-y']
+	if inputFrameRate is not None:
+		cmd += ['-r', str(inputFrameRate)]
+	cmd += ['-i', inputPath]
+	if frameTimestamps:
+		cmd += ['-copyts', '-vf', 'showinfo']
+	cmd += ['-vsync', 'passthrough', '-pix_fmt', 'yuv420p',
+			'-c:v', 'libx264', '-preset', options['preset'], '-crf', str(options['crf'])]
+	if options['threads'] is not None:
+		cmd += ['-threads', str(options['threads'])]
+	cmd += [outputPath]
+
+	# ffmpeg logs to stderr: showinfo logs its time base, then one line per frame, and the
+	# progress line ("frame=  123 fps= ...", ended by carriage returns) is updated as it goes
+	with encodeSlot():
+		print('Transcoding {} ({} frames)...'.format(vidName, nFrames))
+		proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, universal_newlines=True)
+		filterTimeBase = None
+		pts = []
+		nextReport = 10
+		for line in proc.stderr:
+			config = re.search(r'config in time_base: (\d+/\d+)', line)
+			if config:
+				filterTimeBase = parseTimeBase(config.group(1))
+			frameInfo = re.search(r'\sn:\s*\d+\s+pts:\s*(-?\d+)\s+pts_time:', line)
+			if frameInfo:
+				pts.append(int(frameInfo.group(1)))
+			progress = re.match(r'frame=\s*(\d+)', line)
+			if progress and nFrames > 0 and int(progress.group(1)) * 100 >= nextReport * nFrames:
+				print('{}: {}%'.format(vidName, int(int(progress.group(1)) * 100 / nFrames)))
+				nextReport = 10 * (int(progress.group(1)) * 10 // nFrames + 1)
+		if proc.wait() != 0:
+			# don't leave a partial output behind for a later run to find
+			if os.path.exists(outputPath):
+				os.remove(outputPath)
+			raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+	# check that every frame made it into the output
+	nOutputFrames = countFrames(outputPath)
+	if nOutputFrames != nFrames:
+		os.remove(outputPath)
+		raise ValueError('Transcoded {} has {} frames; expected {} (from {})'.format(vidName, nOutputFrames, nFrames, inputPath))
+
+	if frameTimestamps:
+		if len(pts) == 0 or filterTimeBase is None:
+			raise ValueError('Could not read the frame timestamps of {} from ffmpeg'.format(inputPath))
+
+		# the start of the video stream (if ffprobe isn't available, the first frame is taken as the start)
+		try:
+			startPts, timeBase = probeStreamStart(inputPath)
+		except (OSError, ValueError, KeyError, subprocess.CalledProcessError):
+			startPts, timeBase = None, filterTimeBase
+
+		# showinfo reports the pts in the filter's time base; bring them back to the stream's
+		if filterTimeBase != timeBase:
+			pts = [int(round(p * filterTimeBase[0] * timeBase[1] / (filterTimeBase[1] * timeBase[0]))) for p in pts]
+		return ptsToTimestamps(pts, min(pts) if startPts is None else startPts, timeBase)
@@ -5,10 +5,11 @@ Assumes processData.py has already been run.
 
 all of the output will be stored in a 'calibration' directory (e.g. ./data/<condition name>/calibration).
 This directory will contain the following files:
-	- calibration_gazeData.tsv: all of the gaze data aligned with the calibration task trials
-	- calibration_summarized.tsv: a summary of calibration accuracy and precision on each calibration point
+	- gazeData_calibration.<fmt>: all of the gaze data aligned with the calibration task trials (feather by default; see gazeTables.py)
+	- calibrationSummary.tsv: a summary of calibration accuracy and precision on each calibration point
 	- calibrationPlot_raw.pdf: plot of all of the gaze data, colored by trial
 	- calibrationPlot_summary.pdf: plot of summarized accuracy and precision on this run
+		(the plots can be saved as png instead, or skipped, with --plots)
 	- <condition name>_taskLog.txt: the trial timinig for this run
 	- firstFrame_<####>.jpg: image of the frame on which the start image was found
 	- firstFrame.txt: text file containing the frame number of the start image
@@ -26,15 +27,19 @@ import numpy as np
 import pandas as pd
 from os.path import join
 import matplotlib
-matplotlib.use('tkagg')
+matplotlib.use('Agg')		# non-interactive backend; figures are only saved to file
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 
+sys.path.append(join(os.path.dirname(os.path.abspath(__file__)), '..', 'gazeMappingPipeline'))
+from gazeTables import readTable, writeTable, tableFormats
+
 ### Configuration vars
 startImage_path = '../task/startImage.jpg'
 trialDur = 3000
 trialWin = (500, 2500)
 calibGrid_path = '../referenceGrids/calibrationGrid.jpg'
+plotFormats = ['none', 'png', 'pdf']
 
 # dict to store the pixels/deg visual angle on the calibration grid at various distances
 # The calibration grid is 1000px on edge, and 204mm on edge in the real world
@@ -43,17 +48,14 @@ pixPerDeg = {'1M': 85.8, '2M': 171.2, '3M': 256.7}
 # dict to store the fps of gaze data based on different glasses models
 gaze_fps = {'Tobii': 50, 'PupilLabs': 120, 'SMI': 60}
 
-def processCalibration(condition):
-	"""
-	process the calibration data for this condition.
+def loadCalibrationTask(condition):
 	"""
+	Load the mapped gaze data and task log for this condition.
 
-	# parse condition
-	subj, glasses, distance, offset = condition.split('_')
-
-	# store the maximum number of gazepts per trial based on the trial window and glasses sampling Hz
-	idealMaxGazePts = int((trialWin[1]-trialWin[0])/1000 * gaze_fps[glasses])
-
+	Returns:
+		- gaze_df: mapped gaze data, with a task_ts column (ms relative to the task start)
+		- taskLog: the start time, col, and row of each calibration trial
+	"""
 	### set up inputs/outputs
 	dataDir = join('../data', condition)
 	procDir = join(dataDir, 'processed')
@@ -83,152 +85,171 @@ def processCalibration(condition):
 			startFrameNum = int(f.read())
 
 	### find the timestamp of the start image
-	gazeWorld_df = pd.read_table(join(dataDir, 'gazeData_world.tsv'), sep='\t')
+	gazeWorld_df = readTable(join(dataDir, 'gazeData_world'))
 	startImage_df = gazeWorld_df[gazeWorld_df.frame_idx == (startFrameNum-1)].iloc[0]
 	taskStartTime = startImage_df.timestamp
 
 	### Load the mapped gaze data, add column with ts relative to the task
-	gaze_df = pd.read_table(join(procDir, 'gazeData_mapped.tsv'), sep='\t')
+	gaze_df = readTable(join(procDir, 'gazeData_mapped'))
 	gaze_df.loc[:, 'task_ts'] = gaze_df.gaze_ts - taskStartTime
 
 	### Load the task log start times
 	taskLog = pd.read_table(join(calibDir, (condition + '_taskLog.txt')))
+
+	return gaze_df, taskLog
+
+
+def segmentTrials(gaze_df, taskLog, trialDur=trialDur, trialWin=trialWin):
+	"""
+	Assign every gaze sample to the calibration trial it falls in, and keep only
+	the samples within the analysis window of their trial.
+
+	A sample belongs to the latest trial that started before it (and at most trialDur ms before it).
+	Trials are numbered in task log order; ptIdx is the index of the calibration point (counting from L->R, T->B)
+
+	Returns a copy of gaze_df with added trial, ptIdx, col, row, and trial_ts columns, ordered by trial
+	"""
 	calibGridDims = (taskLog.col.max(), taskLog.row.max())
 
-	### Loop through each calibration point
-	for i in range(taskLog.shape[0]):
-		# each point is pd.series object with entries for Col, Row, and Time
-		thisPt = taskLog.iloc[i]
-
-		thisTrial = str(i+1)
-
-		# get trial start time for this pt
-		trialStart = thisPt.time
-
-		# figure out the index location of this point (counting from L->R, T->B)
-		ptIdx = (thisPt.row-1) * calibGridDims[0] + thisPt.col
-
-		# isolate the gaze data that corresponds to this pt only (return a copy of the gaze_df dataframe)
-		trialGaze_df = gaze_df[(gaze_df.task_ts > trialStart) & (gaze_df.task_ts <= (trialStart + trialDur))].copy()
-
-		# Insert col of timestamps relative to the trial onset
-		# trialGaze_df.assign(trial_ts = lambda x: x.task_ts - trialStart)
-		# print(trialGaze_df.columns)
-		trialGaze_df['trial_ts'] = trialGaze_df.task_ts - trialStart
-
-		# isolate the trial data to only those timepoints that fall within the specified analysis window
-		trialGaze_df = trialGaze_df[(trialGaze_df.trial_ts > trialWin[0]) & (trialGaze_df.trial_ts <= trialWin[1])]
-
-		# analyze the trial, if there's any data for this trial
-		if trialGaze_df.shape[0] > 0:
-			# add info about the calibraiton point to the dataframe
-			trialGaze_df['col'] = thisPt.col
-			trialGaze_df['row'] = thisPt.row
-			trialGaze_df['ptIdx'] = ptIdx
-			trialGaze_df['trial'] = thisTrial
-
-			# calculate gaze point distance/angle from the ideal location
-			idealLocation = ((1000/6)*thisPt.col, (1000/6)*thisPt.row)
-			trialGaze_df.loc[:, 'distance'] = trialGaze_df.apply(lambda d: getDistance(idealLocation[0],
-																						idealLocation[1],
-																						d['calibGrid_gazeX'],
-																						d['calibGrid_gazeY'],
-																						distance), axis=1)
-			trialGaze_df.loc[:, 'angle'] = trialGaze_df.apply(lambda d: getAngle(idealLocation[0],
-																					idealLocation[1],
-																					d['calibGrid_gazeX'],
-																					d['calibGrid_gazeY']), axis=1)
-
-
-			# Add this trial's data to the master dataframe for all trials
-			if 'gazeCalibration_df' not in locals():
-				gazeCalibration_df = trialGaze_df.copy()
-			else:
-				gazeCalibration_df = pd.concat([gazeCalibration_df, trialGaze_df], join='outer', ignore_index=True)
-
-			# drop datapts where the distance is more than 5 deg of visual angle away from calib pt
-			trialGaze_df = trialGaze_df[trialGaze_df['distance'] < 5]
-
-			if trialGaze_df.shape[0] > 0:
-				### Summarize this trial ################################
-				# calculate percent of valid timepts
-				percentValid = trialGaze_df.shape[0]/idealMaxGazePts
-
-				# calculate centroid coords (mean gaze X,Y in calib coordinate space)
-				centroidX = np.mean(trialGaze_df.calibGrid_gazeX)
-				centroidY = np.mean(trialGaze_df.calibGrid_gazeY)
-
-				# calculate distance and angle from ideal for the centroid
-				centDist = getDistance(idealLocation[0], idealLocation[1], centroidX, centroidY, distance)
-				centAngle = getAngle(idealLocation[0], idealLocation[1], centroidX, centroidY)
-
-				# calculate precision: RMS (root mean squared) of distance between each gazept and centroid
-				distFromCentroid = trialGaze_df.apply(lambda d: getDistance(centroidX,
-																			centroidY,
-																			d['calibGrid_gazeX'],
-																			d['calibGrid_gazeY'],
-																			distance), axis=1)
-
-				RMS = np.sqrt(np.sum(np.square(distFromCentroid)) * (1/distFromCentroid.shape[0]))
-
-				# write all of this trial's data to a dataframe
-				trialSummary = pd.DataFrame({'trial': thisTrial,
-												'ptIdx':ptIdx,
-												'percentValid':percentValid,
-												'centX':centroidX, 'centY':centroidY,
-												'RMS':RMS,
-												'centDist':centDist, 'centAngle':centAngle}, index=[0])
-			else:
-				# if no datapts are less than 5 deg away from where they should be, write Nans
-				trialSummary = pd.DataFrame({'trial': thisTrial,
-												'ptIdx':ptIdx,
-												'percentValid':0,
-												'centX':np.nan, 'centY':np.nan,
-												'RMS':np.nan,
-												'centDist':np.nan, 'centAngle':np.nan}, index=[0])
-
-			# add this trial summary to the master dataframe for all trials
-			if 'allTrials_summarized' not in locals():
-				allTrials_summarized = trialSummary.copy()
-			else:
-				allTrials_summarized = pd.concat([allTrials_summarized, trialSummary], join='outer', ignore_index=True)
-
-	### Write to text files
+	# trial info, sorted by trial start time
+	trials = taskLog.reset_index(drop=True)
+	trials['trial'] = trials.index + 1
+	trials['ptIdx'] = (trials.row-1) * calibGridDims[0] + trials.col
+	trials = trials.sort_values('time', kind='mergesort')
+	trialStarts = trials.time.values
+
+	# position (in trialStarts) of the latest trial that started before each sample
+	trialPos = np.searchsorted(trialStarts, gaze_df.task_ts.values, side='left') - 1
+	trial_ts = gaze_df.task_ts.values - trialStarts[np.maximum(trialPos, 0)]
+	inTrial = (trialPos >= 0) & (trial_ts <= trialDur)
+
+	# isolate the trial data to only those timepoints that fall within the specified analysis window
+	inWindow = inTrial & (trial_ts > trialWin[0]) & (trial_ts <= trialWin[1])
+	trialGaze_df = gaze_df[inWindow].copy()
+	trialPos = trialPos[inWindow]
+	trialGaze_df['trial_ts'] = trial_ts[inWindow]
+	for c in ['trial', 'ptIdx', 'col', 'row']:
+		trialGaze_df[c] = trials[c].values[trialPos]
+
+	return trialGaze_df.sort_values('trial', kind='mergesort').reset_index(drop=True)
+
+
+def summarizeTrials(gazeCalibration_df, distance, idealMaxGazePts, outlierThresh=5):
+	"""
+	Summarize accuracy and precision on each trial in gazeCalibration_df, ignoring
+	gaze points more than outlierThresh deg of visual angle away from the calibration point
+		- percentValid: proportion of the ideal number of gaze pts that were used
+		- centX, centY: centroid of the gaze pts (calibration grid coords)
+		- centDist, centAngle: distance (deg) and angle of the centroid from the calibration point
+		- RMS: precision, root mean squared distance (deg) of each gaze pt from the centroid
+
+	Trials with no gaze pts within outlierThresh get percentValid of 0, and NaNs elsewhere
+	"""
+	# one row per trial, in trial order
+	trials_df = gazeCalibration_df.drop_duplicates('trial')[['trial', 'ptIdx', 'col', 'row']].set_index('trial')
+
+	# drop datapts where the distance is more than outlierThresh deg of visual angle away from calib pt
+	valid_df = gazeCalibration_df[gazeCalibration_df['distance'] < outlierThresh]
+
+	# accumulate in float64 (coordinates are stored as float32)
+	valid_df = valid_df.assign(calibGrid_gazeX = valid_df.calibGrid_gazeX.astype(np.float64),
+								calibGrid_gazeY = valid_df.calibGrid_gazeY.astype(np.float64))
+	valid_df = valid_df.assign(sqNorm = valid_df.calibGrid_gazeX**2 + valid_df.calibGrid_gazeY**2)
+
+	# per-trial count, centroid, and mean squared norm in a single pass
+	trialStats = valid_df.groupby('trial').agg(nValid=('sqNorm', 'size'),
+												centX=('calibGrid_gazeX', 'mean'),
+												centY=('calibGrid_gazeY', 'mean'),
+												meanSqNorm=('sqNorm', 'mean'))
+	summary_df = trials_df.join(trialStats)
+
+	# calculate percent of valid timepts
+	summary_df['percentValid'] = summary_df.nValid.fillna(0) / idealMaxGazePts
+
+	# calculate distance and angle from ideal for the centroid
+	idealX = (1000/6) * summary_df.col
+	idealY = (1000/6) * summary_df.row
+	summary_df['centDist'] = getDistance(idealX, idealY, summary_df.centX, summary_df.centY, distance)
+	summary_df['centAngle'] = getAngle(idealX, idealY, summary_df.centX, summary_df.centY)
+
+	# calculate precision: RMS of distance between each gazept and centroid
+	# (mean squared distance from the centroid = mean squared norm - squared norm of the centroid)
+	meanSqDist = np.maximum(summary_df.meanSqNorm - summary_df.centX**2 - summary_df.centY**2, 0)
+	summary_df['RMS'] = np.sqrt(meanSqDist) / pixPerDeg[distance]
+
+	return summary_df.reset_index()
+
+
+def processCalibration(condition, plots='pdf', tableFormat=None):
+	"""
+	process the calibration data for this condition.
+
+	plots: file format for the calibration plots ('png', 'pdf'), or 'none' to skip plotting
+	tableFormat: storage format for gazeData_calibration (see gazeTables.py)
+
+	Returns the trial gaze data and the trial summary
+	"""
+
+	# parse condition
+	subj, glasses, distance, offset = condition.split('_')
+
+	# store the maximum number of gazepts per trial based on the trial window and glasses sampling Hz
+	idealMaxGazePts = int((trialWin[1]-trialWin[0])/1000 * gaze_fps[glasses])
+
+	calibDir = join('../data', condition, 'calibration')
+
+	### Load the gaze data, relative to the task start, and the task log
+	gaze_df, taskLog = loadCalibrationTask(condition)
+
+	### assign gaze data to calibration trials
+	gazeCalibration_df = segmentTrials(gaze_df, taskLog)
+
+	# calculate gaze point distance/angle from the ideal location
+	idealX = (1000/6) * gazeCalibration_df.col
+	idealY = (1000/6) * gazeCalibration_df.row
+	gazeCalibration_df['distance'] = getDistance(idealX, idealY,
+										gazeCalibration_df.calibGrid_gazeX, gazeCalibration_df.calibGrid_gazeY, distance)
+	gazeCalibration_df['angle'] = getAngle(idealX, idealY,
+										gazeCalibration_df.calibGrid_gazeX, gazeCalibration_df.calibGrid_gazeY)
+
+	### Summarize each trial
+	allTrials_summarized = summarizeTrials(gazeCalibration_df, distance, idealMaxGazePts)
+
+	### Write the output tables
 	gazeCalibration_colOrder = ['trial', 'ptIdx', 'col', 'row', 'trial_ts', 'task_ts', 'gaze_ts',
 					'worldFrame', 'confidence',
 					'world_gazeX', 'world_gazeY',
 					'border_gazeX', 'border_gazeY',
 					'calibGrid_gazeX', 'calibGrid_gazeY',
 					'distance', 'angle']
-	gazeCalibration_df[gazeCalibration_colOrder].to_csv(join(calibDir, 'gazeData_calibration.tsv'), sep='\t', index=False, float_format='%.3f')
+	writeTable(gazeCalibration_df[gazeCalibration_colOrder], join(calibDir, 'gazeData_calibration'), tableFormat)
 	summary_colOrder = ['trial', 'ptIdx', 'percentValid',
 						'centX', 'centY', 'centDist', 'centAngle', 'RMS']
-	allTrials_summarized[summary_colOrder].to_csv(join(calibDir, 'calibrationSummary.tsv'), sep='\t', index=False, float_format='%.3f')
+	writeTable(allTrials_summarized[summary_colOrder], join(calibDir, 'calibrationSummary'), 'tsv')
 
 	### Plot the results
-	plotCalibrationGaze(gazeCalibration_df, condition, calibDir)
-	plotCalibrationSummary(allTrials_summarized, condition, calibDir)
+	if plots != 'none':
+		plotCalibration(gazeCalibration_df, allTrials_summarized, condition, calibDir, plots)
 
+	return gazeCalibration_df, allTrials_summarized
 
 
 def getDistance(x1,y1,x2,y2, distance):
-	# calculate vector distance between two points, return distance in terms of visual angle
+	# calculate vector distance between two points (or arrays of points), return distance in terms of visual angle
 	xDist = x2-x1
 	yDist = y2-y1
-	gazeDistance = (np.sqrt(xDist**2 + (yDist**2)))/pixPerDeg[distance]
+	gazeDistance = np.hypot(xDist, yDist)/pixPerDeg[distance]
 	return gazeDistance
 
 
 def getAngle(x1,y1,x2,y2):
-	# calculate vector angle between two points
+	# calculate vector angle between two points (or arrays of points)
 	xDist = x2-x1
 	yDist = (y2-y1) * -1   # invert to account for screen origin in top, left
-	
+
 	# calculate the angle between (x1,y1) and (x2,y2)
-	# note: angle will be between 0-180 deg, sign indicates above or below x-axis
-	angle = np.rad2deg(np.arctan2(yDist,xDist))
-	if angle < 0:
-		angle = 360-(-angle)
+	# note: arctan2 returns -180 to 180 deg (sign indicates above or below x-axis); wrap to 0-360
+	angle = np.mod(np.rad2deg(np.arctan2(yDist,xDist)), 360)
 
 	return angle
 
@@ -326,11 +347,30 @@ def findStartFrame(vidPath):
 	return startFrameNum, startFrame
 
 
-def plotCalibrationGaze(gazeCalibration_df, condition, outputDir):
+def loadGridImage():
+	"""
+	Load the calibration grid image (read from disk once, then reused)
+	"""
+	global _gridImg
+	if _gridImg is None:
+		_gridImg = mpimg.imread(calibGrid_path)
+	return _gridImg
+_gridImg = None
+
+
+def plotCalibration(gazeCalibration_df, calibSummary_df, condition, outputDir, fmt='pdf'):
+	"""
+	save both calibration plots for this condition
+	"""
+	plotCalibrationGaze(gazeCalibration_df, condition, outputDir, fmt)
+	plotCalibrationSummary(calibSummary_df, condition, outputDir, fmt)
+
+
+def plotCalibrationGaze(gazeCalibration_df, condition, outputDir, fmt='pdf'):
 	"""
 	plot all the gazepts for each calibration trial
 	"""
-	gridImg = mpimg.imread(calibGrid_path)
+	gridImg = loadGridImage()
 
 	# axis formatting
 	matplotlib.rc('ytick', labelsize=20)
@@ -367,15 +407,15 @@ def plotCalibrationGaze(gazeCalibration_df, condition, outputDir):
 
 	### save
 	plt.tight_layout()
-	plt.savefig(join(outputDir, 'calibrationPlot_raw.pdf'))
+	plt.savefig(join(outputDir, 'calibrationPlot_raw.' + fmt))
 	plt.close()
 
 
-def plotCalibrationSummary(calibSummary_df, condition, outputDir):
+def plotCalibrationSummary(calibSummary_df, condition, outputDir, fmt='pdf'):
 	"""
 	plot the summary of gaze calibration for this subject
 	"""
-	gridImg = mpimg.imread(calibGrid_path)
+	gridImg = loadGridImage()
 
 	# axis formatting
 	matplotlib.rc('ytick', labelsize=20)
@@ -444,7 +484,7 @@ def plotCalibrationSummary(calibSummary_df, condition, outputDir):
 
 	### save
 	plt.tight_layout()
-	plt.savefig(join(outputDir, 'calibrationPlot_summary.pdf'))
+	plt.savefig(join(outputDir, 'calibrationPlot_summary.' + fmt))
 	plt.close()
 
 
@@ -452,10 +492,12 @@ if __name__ == '__main__':
 	# parse arguments
 	parser = argparse.ArgumentParser()
 	parser.add_argument('condition', help='name of the experimental condition (e.g. 101_Tobii_1M_0deg')
+	parser.add_argument('--plots', choices=plotFormats, default='pdf', help='calibration plot format, or none')
+	parser.add_argument('--tableFormat', choices=tableFormats, default=None, help='storage format for the calibration gaze data')
 	args = parser.parse_args()
 
 	# check if valid condition
 	if not os.path.isdir(join('../data', args.condition, 'processed')):
 		print('Cannot find a "Processed" directory in ./data/{}'.format(args.condition))
 	else:
-		processCalibration(args.condition)
+		processCalibration(args.condition, plots=args.plots, tableFormat=args.tableFormat)
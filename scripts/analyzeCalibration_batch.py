@@ -1,11 +1,21 @@
 """
 Batch submit multiple subjects to the analyzeCalibration script
+
+The calibration analysis runs on each condition in turn; once all conditions are
+analyzed, the plots are rendered in parallel across a pool of worker processes
 """
 
+# python 2/3 compatibility
+from __future__ import print_function
+
 import os
+import argparse
+import multiprocessing
 from os.path import join
 import pandas as pd
 
+from analyzeCalibration import processCalibration, plotCalibration, plotFormats, tableFormats
+
 conditions = []
 for subj in ['101', '102', '103']:
 	for glasses in ['PupilLabs', 'SMI', 'Tobii']:
@@ -21,11 +31,32 @@ for subj in ['101', '102', '103']:
 # metadata_df['condition'] = metadata_df['Subj'].map(str) + '_' + metadata_df['Glasses'] + '_' + metadata_df['Distance'] + '_' + metadata_df['Offset']
 
 
-for cond in conditions:
-	print('Submitting job for: {}'.format(cond))
+if __name__ == '__main__':
+	# parse arguments
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--plots', choices=plotFormats, default='pdf', help='calibration plot format, or none')
+	parser.add_argument('--tableFormat', choices=tableFormats, default=None, help='storage format for the calibration gaze data')
+	parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of plotting processes')
+	args = parser.parse_args()
+
+	### analyze every condition
+	plotJobs = []
+	for cond in conditions:
+		if not os.path.isdir(join('../data', cond, 'processed')):
+			print('Cannot find a "Processed" directory in ./data/{}'.format(cond))
+			continue
+		print('Analyzing: {}'.format(cond))
+
+		try:
+			gazeCalibration_df, calibSummary_df = processCalibration(cond, plots='none', tableFormat=args.tableFormat)
+			plotJobs.append((gazeCalibration_df, calibSummary_df, cond, join('../data', cond, 'calibration'), args.plots))
+		except Exception as e:
+			print('FAILED TO RUN:  {} ({})'.format(cond, e))
 
-	try:
-		cmd_str = 'python analyzeCalibration.py ' + cond
-		os.system(cmd_str)
-	except:
-		print('FAILED TO RUN:  {}'.format(cond))
+	### plot all conditions in parallel
+	if args.plots != 'none' and len(plotJobs) > 0:
+		print('Plotting {} conditions...'.format(len(plotJobs)))
+		pool = multiprocessing.Pool(min(args.workers, len(plotJobs)))
+		pool.starmap(plotCalibration, plotJobs)
+		pool.close()
+		pool.join()
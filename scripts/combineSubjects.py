@@ -1,13 +1,16 @@
 """
-Combine the calibrationSummary.tsv files for all
+Combine the calibrationSummary tables for all
 conditions for all subjects
 """
 from __future__ import print_function
 from __future__ import division
-import os
+import os, sys
 from os.path     import join
 import pandas as pd
 
+sys.path.append(join(os.path.dirname(os.path.abspath(__file__)), '..', 'gazeMappingPipeline'))
+from gazeTables import readTable
+
 data_dir = '../data'
 analysis_dir = '../analysis'
 
@@ -19,8 +22,8 @@ for subj in ['101', '102', '103']:
                 thisCond = '_'.join([subj, glasses, dist, offset])
 
                 # load the calib summary for this condition
-                calibSummary_path = join(data_dir, thisCond, 'calibration/calibrationSummary.tsv')
-                calibSummary_df = pd.read_table(calibSummary_path, sep='\t')
+                calibSummary_path = join(data_dir, thisCond, 'calibration/calibrationSummary')
+                calibSummary_df = readTable(calibSummary_path)
 
                 # take the mean across all pts
                 # calibSummary_df = calibSummary_df.mean()
@@ -0,0 +1,168 @@
+"""
+Compute precision and data loss metrics on each calibration trial, for all conditions
+
+Assumes analyzeCalibration.py has already been run for each condition.
+
+The calibration gaze data (gazeData_calibration) for all conditions is combined into
+one table, and all metrics are computed per trial in a single grouped pass over it:
+	- nSamples:		number of gaze samples recorded in the analysis window
+	- dataLoss:		proportion of the expected samples (window duration x sampling rate) that are missing or invalid
+	- propInvalid:	proportion of the recorded samples that are invalid
+	- STD:			standard deviation of gaze position (deg); sqrt(var x + var y)
+					(same as the "RMS" from the centroid reported in calibrationSummary.tsv)
+	- RMS_S2S:		root mean square of the distances between successive samples (deg)
+	- BCEA:			bivariate contour ellipse area (deg^2), containing bceaProportion of the samples
+
+Samples are valid if they fall within outlierThresh deg of the calibration point (as in analyzeCalibration.py).
+
+To add a metric, add any per-sample terms it needs to sampleTerms, and an entry to metricRegistry
+that computes it from the per-trial sums of those terms.
+
+Output:
+	- ../analysis/allSubjs_precisionMetrics.tsv
+"""
+
+# python 2/3 compatibility
+from __future__ import division
+from __future__ import print_function
+
+import os, sys
+import argparse
+import itertools
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+from os.path import join
+
+sys.path.append(join(os.path.dirname(os.path.abspath(__file__)), '..', 'gazeMappingPipeline'))
+from gazeTables import readTable, findTable
+from analyzeCalibration import pixPerDeg, gaze_fps, trialWin
+
+### Configuration vars
+data_dir = '../data'
+analysis_dir = '../analysis'
+bceaProportion = 0.682		# proportion of samples within the BCEA ellipse
+
+
+### Per-sample terms; each is summed per trial
+# d is the combined gaze table, with x, y (deg), valid, hasPrev, and s2sSq columns
+sampleTerms = OrderedDict([
+	('n', lambda d: np.ones(d.shape[0])),
+	('nValid', lambda d: d.valid),
+	('sumX', lambda d: d.valid * d.x),
+	('sumY', lambda d: d.valid * d.y),
+	('sumX2', lambda d: d.valid * d.x**2),
+	('sumY2', lambda d: d.valid * d.y**2),
+	('sumXY', lambda d: d.valid * d.x * d.y),
+	('nS2S', lambda d: d.hasPrev),
+	('sumS2S', lambda d: d.s2sSq)])
+
+
+def _variances(t):
+	"""
+	(population) variance of x, y, and covariance of x,y on the valid samples of each trial
+	"""
+	meanX = t.sumX / t.nValid
+	meanY = t.sumY / t.nValid
+	varX = np.maximum(t.sumX2 / t.nValid - meanX**2, 0)
+	varY = np.maximum(t.sumY2 / t.nValid - meanY**2, 0)
+	covXY = t.sumXY / t.nValid - meanX * meanY
+	return varX, varY, covXY
+
+
+def _bcea(t):
+	varX, varY, covXY = _variances(t)
+	k = -np.log(1 - bceaProportion)
+	rhoSq = np.where(varX*varY > 0, covXY**2 / (varX*varY), 0)
+	return 2 * k * np.pi * np.sqrt(varX) * np.sqrt(varY) * np.sqrt(1 - rhoSq)
+
+
+def _nExpected(t):
+	fps = t.index.get_level_values('glasses').map(gaze_fps).values
+	return (trialWin[1] - trialWin[0]) / 1000 * fps
+
+
+### Metrics, computed from the per-trial sums (t: dataframe of sums, indexed by condition, glasses, dist, trial, ptIdx)
+metricRegistry = OrderedDict([
+	('nSamples', lambda t: t.n),
+	('dataLoss', lambda t: np.clip(1 - t.nValid / _nExpected(t), 0, 1)),
+	('propInvalid', lambda t: 1 - t.nValid / t.n),
+	('STD', lambda t: np.sqrt(_variances(t)[0] + _variances(t)[1])),
+	('RMS_S2S', lambda t: np.sqrt(t.sumS2S / t.nS2S)),
+	('BCEA', _bcea)])
+
+
+def loadCalibrationGaze(conditions):
+	"""
+	Load and combine the calibration gaze data for the given conditions
+	"""
+	allGaze = []
+	for cond in conditions:
+		gaze_path = join(data_dir, cond, 'calibration', 'gazeData_calibration')
+		if findTable(gaze_path) is None:
+			print('No calibration gaze data for: {}'.format(cond))
+			continue
+		gaze_df = readTable(gaze_path, columns=['trial', 'ptIdx', 'gaze_ts', 'calibGrid_gazeX', 'calibGrid_gazeY', 'distance'])
+		subj, glasses, dist, offset = cond.split('_')
+		gaze_df['condition'] = cond
+		gaze_df['glasses'] = glasses
+		gaze_df['dist'] = dist
+		allGaze.append(gaze_df)
+
+	return pd.concat(allGaze, ignore_index=True)
+
+
+def computeMetrics(gaze_df, outlierThresh=5):
+	"""
+	Compute every metric in metricRegistry for each trial of each condition in gaze_df
+	"""
+	gaze_df = gaze_df.sort_values(['condition', 'trial', 'gaze_ts'], kind='mergesort').reset_index(drop=True)
+
+	### per-sample values, for all conditions at once
+	ppd = gaze_df.dist.map(pixPerDeg).values
+	d = pd.DataFrame({'x': np.nan_to_num(gaze_df.calibGrid_gazeX.values / ppd),
+					'y': np.nan_to_num(gaze_df.calibGrid_gazeY.values / ppd),
+					'valid': (gaze_df.distance < outlierThresh).values})		# NaN distance is never valid
+
+	# squared distance from the previous valid sample in the same trial (0 on the first)
+	validIdx = np.flatnonzero(d.valid.values)
+	key = gaze_df.condition.values[validIdx] + '_' + gaze_df.trial.astype(str).values[validIdx]
+	sameTrial = key[1:] == key[:-1]
+	hasPrev = np.zeros(d.shape[0], dtype=bool)
+	hasPrev[validIdx[1:][sameTrial]] = True
+	s2sSq = np.zeros(d.shape[0])
+	s2sSq[hasPrev] = (np.diff(d.x.values[validIdx])**2 + np.diff(d.y.values[validIdx])**2)[sameTrial]
+	d['hasPrev'] = hasPrev
+	d['s2sSq'] = s2sSq
+
+	### sum every term per trial in one grouped pass
+	terms = pd.DataFrame(OrderedDict((name, np.asarray(f(d), dtype=float)) for name, f in sampleTerms.items()))
+	for c in ['condition', 'glasses', 'dist', 'trial', 'ptIdx']:
+		terms[c] = gaze_df[c].values
+	trialSums = terms.groupby(['condition', 'glasses', 'dist', 'trial', 'ptIdx'], sort=False).sum()
+
+	### compute the metrics from the sums
+	with np.errstate(invalid='ignore', divide='ignore'):
+		metrics_df = pd.DataFrame(OrderedDict((name, np.asarray(f(trialSums), dtype=float))
+												for name, f in metricRegistry.items()), index=trialSums.index)
+
+	return metrics_df.reset_index()
+
+
+if __name__ == '__main__':
+	# all conditions, by default
+	allConditions = ['_'.join(c) for c in itertools.product(['101', '102', '103'],
+															['PupilLabs', 'SMI', 'Tobii'],
+															['1M', '2M', '3M'],
+															['0deg', '10Ldeg', '10Rdeg'])]
+
+	# parse arguments
+	parser = argparse.ArgumentParser()
+	parser.add_argument('conditions', nargs='*', default=allConditions,
+						help='names of the experimental conditions (e.g. 101_Tobii_1M_0deg); default: all')
+	parser.add_argument('--outlierThresh', type=float, default=5, help='max distance (deg) from the calibration point')
+	parser.add_argument('--output', default=join(analysis_dir, 'allSubjs_precisionMetrics.tsv'), help='output file')
+	args = parser.parse_args()
+
+	metrics_df = computeMetrics(loadCalibrationGaze(args.conditions), outlierThresh=args.outlierThresh)
+	metrics_df.to_csv(args.output, sep='\t', index=False, float_format='%.4f')
@@ -19,7 +19,7 @@ Output:
 	- world_gaze.mp4:		world video w/ gaze points overlaid
 	- border_gaze.mp4:		video of border image w/ gaze points overlaid
 	- calibGrid_gaze.mp4:	video of calibration grid w/ gaze point overlaid
-	- gazeData_mapped.tsv:	gazeData mapped to all 3 coordinate systems
+	- gazeData_mapped.<fmt>:	gazeData mapped to all 3 coordinate systems (feather by default; see gazeTables.py)
 """
 
 # python 2/3 compatibility
@@ -36,6 +36,9 @@ import pandas as pd
 from os.path import join
 import cv2
 
+sys.path.append(join(os.path.dirname(os.path.abspath(__file__)), '..', 'gazeMappingPipeline'))
+from gazeTables import readTable, writeTable, findTable, tableFormats
+
 ### configuration vars
 border_path = '../referenceGrids/enhancedGrid.jpg'
 calibGrid_path = '../referenceGrids/calibrationGrid.jpg'
@@ -54,10 +57,10 @@ def copyPreprocessing(preprocessedDir, condition):
 	if not os.path.isdir(outputDir):
 		os.makedirs(outputDir)
 
-	# copy files
-	for f in ['worldCamera.mp4', 'gazeData_world.tsv', 'frame_timestamps.tsv']:
-		src = join(preprocessedDir, f)
-		shutil.copy(src, outputDir)
+	# copy files (the gaze tables in whichever format they were written)
+	shutil.copy(join(preprocessedDir, 'worldCamera.mp4'), outputDir)
+	for f in ['gazeData_world', 'frame_timestamps']:
+		shutil.copy(findTable(join(preprocessedDir, f)), outputDir)
 
 
 def findMatches(img1_kp, img1_des, img2_kp, img2_des):
@@ -132,12 +135,14 @@ def projectImage2D(origFrame, transform2D, newImage):
 	return newFrame
 
 
-def processRecording(condition):
+def processRecording(condition, tableFormat=None):
 	"""
 	process the preprocessed data saved in the directory specifed by 'condition'
 
 	Map the gaze data from the source video coordinate system to the
 	background image, and ultimately to the calibration grid itself.
+
+	tableFormat: storage format for gazeData_mapped (see gazeTables.py)
 	"""
 
 	### SetUp inputs/outputs
@@ -153,7 +158,7 @@ def processRecording(condition):
 		shutil.copy(f, procDir)
 
 	# load gaze data
-	gazeWorld_df = pd.read_table(join(dataDir, 'gazeData_world.tsv'), sep='\t')
+	gazeWorld_df = readTable(join(dataDir, 'gazeData_world'))
 
 	### Load the border and calibration grid images
 	borderImg = cv2.imread(join(procDir, border_path.split('/')[-1]))
@@ -319,10 +324,10 @@ def processRecording(condition):
 			try:
 				colOrder = ['worldFrame', 'gaze_ts', 'confidence',
 							'world_gazeX', 'world_gazeY', 'border_gazeX', 'border_gazeY', 'calibGrid_gazeX', 'calibGrid_gazeY']
-				gazeMapped_df[colOrder].to_csv(join(procDir, 'gazeData_mapped.tsv'), sep='\t', index=False, float_format='%.3f')
+				writeTable(gazeMapped_df[colOrder], join(procDir, 'gazeData_mapped'), tableFormat)
 			except Exception as e:
 				print(e)
-				print('cound not write gazeData_mapped to csv')
+				print('cound not write gazeData_mapped')
 				pass
 
 			# close the logFile
@@ -402,6 +407,7 @@ if __name__ == '__main__':
 	parser = argparse.ArgumentParser()
 	parser.add_argument('preprocessedDir', help='path to preprocessed data dir')
 	parser.add_argument('condition', help='name of the experimental condition (e.g. 101_Tobii_1M_0deg)')
+	parser.add_argument('--tableFormat', choices=tableFormats, default=None, help='storage format for the mapped gaze data')
 	args = parser.parse_args()
 
 	## error checking
@@ -414,4 +420,4 @@ if __name__ == '__main__':
 
 		## process the recording
 		print('processing the recording...')
-		processRecording(args.condition)
+		processRecording(args.condition, tableFormat=args.tableFormat)
@@ -0,0 +1,159 @@
+"""
+Parameter sweep for the calibration analysis
+
+Assumes processData.py has already been run for each condition.
+
+analyzeCalibration.py summarizes each calibration trial using a fixed trial duration,
+analysis window, and outlier threshold. This script evaluates a whole grid of those
+settings at once, to check how sensitive the accuracy and precision results are to them.
+The gaze data for each condition is loaded once, and every combination of settings is
+evaluated in a single vectorized pass over it.
+
+Output (tidy; one row per condition x settings x trial):
+	- ../analysis/calibrationSweep.tsv
+"""
+
+# python 2/3 compatibility
+from __future__ import division
+from __future__ import print_function
+
+import os
+import argparse
+import itertools
+import numpy as np
+import pandas as pd
+from os.path import join
+
+from analyzeCalibration import loadCalibrationTask, segmentTrials, getDistance, getAngle, pixPerDeg, gaze_fps
+
+### Configuration vars (default grid)
+trialDurs = [3000]
+windowStarts = [0, 250, 500, 750, 1000]
+windowEnds = [2000, 2500, 3000]
+outlierThreshs = [2, 3, 4, 5, 10]
+
+
+def trialSums(trialPos, nTrials, values):
+	"""
+	Sum each column of values (samples x combos) within every trial; returns trials x combos
+	"""
+	return np.column_stack([np.bincount(trialPos, weights=values[:,k], minlength=nTrials)
+							for k in range(values.shape[1])])
+
+
+def sweepCondition(condition, trialDurs, windows, outlierThreshs):
+	"""
+	Summarize every calibration trial in this condition under every combination of
+	trial duration, analysis window (start, end; ms), and outlier threshold (deg)
+
+	Uses the same definitions as analyzeCalibration.summarizeTrials
+	"""
+	subj, glasses, distance, offset = condition.split('_')
+
+	### load the gaze data once
+	gaze_df, taskLog = loadCalibrationTask(condition)
+
+	allResults = []
+	for thisTrialDur in trialDurs:
+		# settings that fit within this trial duration
+		combos = [(w, t) for w, t in itertools.product(windows, outlierThreshs) if w[1] <= thisTrialDur]
+		if len(combos) == 0:
+			continue
+		winStart = np.array([w[0] for w, t in combos])
+		winEnd = np.array([w[1] for w, t in combos])
+		thresh = np.array([t for w, t in combos])
+
+		# assign samples to trials, keeping everything within the trial
+		trialGaze_df = segmentTrials(gaze_df, taskLog, trialDur=thisTrialDur, trialWin=(-np.inf, thisTrialDur))
+		if trialGaze_df.shape[0] == 0:
+			continue
+		trials_df = trialGaze_df.drop_duplicates('trial')[['trial', 'ptIdx', 'col', 'row']]
+		trialPos = np.searchsorted(trials_df.trial.values, trialGaze_df.trial.values)
+
+		# per-sample values
+		x = trialGaze_df.calibGrid_gazeX.values.astype(np.float64)		# stored as float32
+		y = trialGaze_df.calibGrid_gazeY.values.astype(np.float64)
+		trial_ts = trialGaze_df.trial_ts.values
+		dist = getDistance((1000/6) * trialGaze_df.col.values, (1000/6) * trialGaze_df.row.values, x, y, distance)
+
+		### masks for every combination of settings (samples x combos)
+		inWindow = (trial_ts[:,None] > winStart) & (trial_ts[:,None] <= winEnd)
+		valid = inWindow & (dist[:,None] < thresh)		# NaN distance is never valid
+
+		### per trial sums for every combination (trials x combos)
+		nTrials = trials_df.shape[0]
+		x0 = np.nan_to_num(x)
+		y0 = np.nan_to_num(y)
+		nInWindow = trialSums(trialPos, nTrials, inWindow)
+		nValid = trialSums(trialPos, nTrials, valid)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			centX = trialSums(trialPos, nTrials, valid * x0[:,None]) / nValid
+			centY = trialSums(trialPos, nTrials, valid * y0[:,None]) / nValid
+			meanSqNorm = trialSums(trialPos, nTrials, valid * (x0**2 + y0**2)[:,None]) / nValid
+		RMS = np.sqrt(np.maximum(meanSqNorm - centX**2 - centY**2, 0)) / pixPerDeg[distance]
+
+		idealX = (1000/6) * trials_df.col.values[:,None]
+		idealY = (1000/6) * trials_df.row.values[:,None]
+		centDist = getDistance(idealX, idealY, centX, centY, distance)
+		centAngle = getAngle(idealX, idealY, centX, centY)
+		idealMaxGazePts = ((winEnd - winStart)/1000 * gaze_fps[glasses]).astype(int)
+
+		### tidy output: only trials with data in the window (as in analyzeCalibration)
+		p, k = np.nonzero(nInWindow > 0)
+		results = pd.DataFrame({'trialDur': thisTrialDur,
+								'winStart': winStart[k], 'winEnd': winEnd[k], 'outlierThresh': thresh[k],
+								'trial': trials_df.trial.values[p], 'ptIdx': trials_df.ptIdx.values[p],
+								'percentValid': nValid[p,k] / idealMaxGazePts[k],
+								'centX': centX[p,k], 'centY': centY[p,k],
+								'centDist': centDist[p,k], 'centAngle': centAngle[p,k],
+								'RMS': RMS[p,k]})
+		allResults.append(results)
+
+	sweep_df = pd.concat(allResults, ignore_index=True)
+	sweep_df = sweep_df.sort_values(['trialDur', 'winStart', 'winEnd', 'outlierThresh', 'trial'], kind='mergesort')
+
+	# add condition cols
+	sweep_df['condition'] = condition
+	sweep_df['subj'] = subj
+	sweep_df['glasses'] = 'Pupil Labs' if glasses == 'PupilLabs' else glasses		# reformat pupil labs to include space
+	sweep_df['dist'] = distance
+	sweep_df['offset'] = offset
+
+	return sweep_df
+
+
+if __name__ == '__main__':
+	# all conditions, by default
+	allConditions = ['_'.join(c) for c in itertools.product(['101', '102', '103'],
+															['PupilLabs', 'SMI', 'Tobii'],
+															['1M', '2M', '3M'],
+															['0deg', '10Ldeg', '10Rdeg'])]
+
+	# parse arguments
+	parser = argparse.ArgumentParser()
+	parser.add_argument('conditions', nargs='*', default=allConditions,
+						help='names of the experimental conditions (e.g. 101_Tobii_1M_0deg); default: all')
+	parser.add_argument('--trialDurs', type=float, nargs='+', default=trialDurs, help='trial durations (ms)')
+	parser.add_argument('--windowStarts', type=float, nargs='+', default=windowStarts, help='analysis window starts (ms)')
+	parser.add_argument('--windowEnds', type=float, nargs='+', default=windowEnds, help='analysis window ends (ms)')
+	parser.add_argument('--outlierThreshs', type=float, nargs='+', default=outlierThreshs, help='outlier thresholds (deg)')
+	parser.add_argument('--output', default=join('../analysis', 'calibrationSweep.tsv'), help='output file')
+	args = parser.parse_args()
+
+	windows = [(s, e) for s, e in itertools.product(args.windowStarts, args.windowEnds) if s < e]
+
+	allSweeps = []
+	for cond in args.conditions:
+		# check if valid condition
+		if not os.path.isdir(join('../data', cond, 'processed')):
+			print('Cannot find a "Processed" directory in ./data/{}'.format(cond))
+			continue
+		print('Sweeping: {}'.format(cond))
+		allSweeps.append(sweepCondition(cond, args.trialDurs, windows, args.outlierThreshs))
+
+	# write the output
+	colOrder = ['condition', 'subj', 'glasses', 'dist', 'offset',
+				'trialDur', 'winStart', 'winEnd', 'outlierThresh',
+				'trial', 'ptIdx', 'percentValid', 'centX', 'centY', 'centDist', 'centAngle', 'RMS']
+	sweep_df = pd.concat(allSweeps, ignore_index=True)
+	sweep_df[colOrder].to_csv(args.output, sep='\t', index=False, float_format='%.4f')